@@ -0,0 +1,345 @@
+import sys, time, heapq
+from array import array
+from bisect import bisect_left, bisect_right
+
+# the text fields of an address point, kept as ids into one table of
+# interned strings. the house number is kept as an integer
+STRING_FIELDS = ('address_fr', 'prefix_dir', 'prefix_typ', 'street_nam',
+                 'suffix_dir', 'street_typ', 'segment_id', 'parent_pla',
+                 'place_id', 'full_stree')
+
+NUMBER_FIELD = 'address'
+
+STREET_FIELD = 'street_nam'
+
+# how many similar streets a misspelt name is looked up on, and how
+# similar they have to be, from 0 to 1
+TOP_STREETS = 5
+
+MIN_SIMILARITY = 0.4
+
+# side in map units (feet in EPSG:2277) of the cells of the spatial grid
+GRID_CELL_SIZE = 500.0
+
+def trigrams(text):
+    """returns the set of three letter sequences of the padded text"""
+    text = "  {} ".format(text)
+    return set(text[index:index + 3] for index in range(len(text) - 2))
+
+def parse_number(value):
+    """returns the house number as an integer, 0 if there is none"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+class SpatialGrid(object):
+    """the rows of the points in each cell of a uniform grid. cell_keys
+    holds the keys (y * columns + x) of the cells that have points, in
+    order, and the rows of the points in cell_keys[i] are
+    cell_rows[cell_starts[i]:cell_starts[i + 1]]
+    """
+    def __init__(self, cell_size, min_x, min_y, columns, cell_keys,
+                 cell_starts, cell_rows):
+        self.cell_size = cell_size
+        self.min_x = min_x
+        self.min_y = min_y
+        self.columns = columns
+        self.cell_keys = cell_keys
+        self.cell_starts = cell_starts
+        self.cell_rows = cell_rows
+
+    @classmethod
+    def build(cls, xs, ys, cell_size=GRID_CELL_SIZE):
+        min_x = min(xs) if len(xs) else 0.0
+        min_y = min(ys) if len(ys) else 0.0
+        columns = int((max(xs) - min_x) // cell_size) + 1 if len(xs) else 1
+
+        keys = [int((y - min_y) // cell_size) * columns +
+                int((x - min_x) // cell_size) for x, y in zip(xs, ys)]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+
+        cell_keys = array('q')
+        cell_starts = array('l')
+        cell_rows = array('l', order)
+        for position, row in enumerate(order):
+            if not cell_keys or cell_keys[-1] != keys[row]:
+                cell_keys.append(keys[row])
+                cell_starts.append(position)
+        cell_starts.append(len(order))
+
+        return cls(cell_size, min_x, min_y, columns, cell_keys, cell_starts,
+                   cell_rows)
+
+    def cell_range(self, key):
+        """returns the first and last + 1 position in cell_rows of the
+        points in the cell with key
+        """
+        index = bisect_left(self.cell_keys, key)
+        if index == len(self.cell_keys) or self.cell_keys[index] != key:
+            return 0, 0
+        return self.cell_starts[index], self.cell_starts[index + 1]
+
+    def nearest(self, xs, ys, x, y, count, distance):
+        """returns up to count (distance, row) for the points in xs and
+        ys nearest to x, y and no farther than distance, nearest first
+        """
+        size = self.cell_size
+        first_column = max(0, int((x - distance - self.min_x) // size))
+        last_column = min(self.columns - 1, int((x + distance - self.min_x) // size))
+        first_row = max(0, int((y - distance - self.min_y) // size))
+        last_row = int((y + distance - self.min_y) // size)
+
+        limit = distance * distance
+        found = []
+        for cell_row in range(first_row, last_row + 1):
+            for cell_column in range(first_column, last_column + 1):
+                start, end = self.cell_range(cell_row * self.columns + cell_column)
+                for position in range(start, end):
+                    row = self.cell_rows[position]
+                    squared = (xs[row] - x) ** 2 + (ys[row] - y) ** 2
+                    if squared <= limit:
+                        found.append((squared, row))
+
+        return [(squared ** 0.5, row)
+                for squared, row in heapq.nsmallest(count, found)]
+
+class TrigramIndex(object):
+    """the streets whose names contain each trigram. grams holds the
+    trigrams in order, the streets containing grams[i] are
+    streets[starts[i]:starts[i + 1]], and counts[street] is the number
+    of trigrams in the name of the street
+    """
+    def __init__(self, grams, starts, streets, counts):
+        self.grams = grams
+        self.starts = starts
+        self.streets = streets
+        self.counts = counts
+
+    @classmethod
+    def build(cls, names):
+        """builds the index from the street names, in street order"""
+        postings = {}
+        counts = array('l')
+        for street, name in enumerate(names):
+            grams = trigrams(name)
+            counts.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(street)
+
+        grams = sorted(postings)
+        starts = array('l')
+        streets = array('l')
+        for gram in grams:
+            starts.append(len(streets))
+            streets.extend(postings[gram])
+        starts.append(len(streets))
+
+        return cls(grams, starts, streets, counts)
+
+    def streets_with(self, gram):
+        """returns the streets whose names contain gram"""
+        index = bisect_left(self.grams, gram)
+        if index == len(self.grams) or self.grams[index] != gram:
+            return ()
+        return self.streets[self.starts[index]:self.starts[index + 1]]
+
+class AddressIndex(object):
+    """the address points held column by column, sorted by street name
+    and then house number. the points of a street are the rows from
+    street_starts[street] to street_starts[street + 1], and within them
+    the house numbers can be bisected
+    """
+    def __init__(self, strings, streets, street_starts, numbers, xs, ys,
+                 columns, grid=None, trigram_index=None):
+        self.strings = strings
+        self.streets = streets
+        self.street_starts = street_starts
+        self.numbers = numbers
+        self.xs = xs
+        self.ys = ys
+        self.columns = columns
+        self.grid = grid or SpatialGrid.build(xs, ys)
+        self.trigram_index = trigram_index or TrigramIndex.build(
+            self.street_name(street) for street in range(len(streets)))
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @classmethod
+    def build(cls, records):
+        """builds the index from (fields, x, y) records, fields being a
+        dictionary of field name to value
+        """
+        strings = []
+        string_ids = {}
+
+        def intern(value):
+            value = '' if value is None else str(value)
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = string_ids[value] = len(strings)
+                strings.append(value)
+            return string_id
+
+        rows = []
+        for fields, x, y in records:
+            rows.append((fields.get(STREET_FIELD) or '',
+                         parse_number(fields.get(NUMBER_FIELD)),
+                         float(x), float(y),
+                         [intern(fields.get(field)) for field in STRING_FIELDS]))
+        rows.sort(key=lambda row: (row[0], row[1]))
+
+        streets = array('l')
+        street_starts = array('l')
+        numbers = array('l')
+        xs = array('d')
+        ys = array('d')
+        columns = dict((field, array('l')) for field in STRING_FIELDS)
+
+        street = None
+        for index, (name, number, x, y, values) in enumerate(rows):
+            if name != street:
+                street = name
+                streets.append(intern(name))
+                street_starts.append(index)
+            numbers.append(number)
+            xs.append(x)
+            ys.append(y)
+            for field, value in zip(STRING_FIELDS, values):
+                columns[field].append(value)
+        street_starts.append(len(rows))
+
+        return cls(strings, streets, street_starts, numbers, xs, ys, columns)
+
+    @classmethod
+    def load(cls, path):
+        """builds the index from the address point shapefile at path"""
+        from osgeo import ogr
+
+        data_source = ogr.Open(path, 0)
+        if data_source is None:
+            raise Exception("Could not open {}".format(path))
+        layer = data_source.GetLayer()
+
+        def records():
+            for feature in layer:
+                geometry = feature.GetGeometryRef()
+                if geometry is None:
+                    continue
+                fields = dict((field, feature.GetFieldAsString(field))
+                              for field in STRING_FIELDS + (NUMBER_FIELD,))
+                yield fields, geometry.GetX(), geometry.GetY()
+
+        return cls.build(records())
+
+    def street_name(self, street):
+        return self.strings[self.streets[street]]
+
+    def street_id(self, name):
+        """returns the street named name, or None. the streets are in
+        order of their names, so this is a binary search
+        """
+        low, high = 0, len(self.streets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.street_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.streets) and self.street_name(low) == name:
+            return low
+        return None
+
+    def similar_streets(self, name, count=TOP_STREETS,
+                        min_similarity=MIN_SIMILARITY):
+        """returns up to count (similarity, street) for the streets whose
+        names share the most trigrams with name, most similar first
+        """
+        grams = trigrams(name)
+        shared = {}
+        for gram in grams:
+            for street in self.trigram_index.streets_with(gram):
+                shared[street] = shared.get(street, 0) + 1
+
+        # the dice coefficient of the two sets of trigrams
+        counts = self.trigram_index.counts
+        scored = ((2.0 * common / (len(grams) + counts[street]), street)
+                  for street, common in shared.items())
+        return [(similarity, street)
+                for similarity, street in heapq.nlargest(count, scored)
+                if similarity >= min_similarity]
+
+    def find_streets(self, name):
+        """returns [(1.0, street)] for the street named name, or failing
+        that the most similar streets, see similar_streets
+        """
+        street = self.street_id(name)
+        if street is not None:
+            return [(1.0, street)]
+        return self.similar_streets(name)
+
+    def street_rows(self, street, number=None, over_under=0):
+        """returns the first and last + 1 row of the street, only those
+        whose number is within over_under (exclusive) of number if given
+        """
+        start = self.street_starts[street]
+        end = self.street_starts[street + 1]
+        if number is None:
+            return start, end
+        return (bisect_right(self.numbers, number - over_under, start, end),
+                bisect_left(self.numbers, number + over_under, start, end))
+
+    def find(self, number=None, street=None, over_under=0):
+        """returns (row, similarity) for the rows on the street, or every
+        street, whose number is within over_under (exclusive) of number,
+        or all if it is None. similarity is how close the street name of
+        the row is to street, from 0 to 1
+        """
+        if street is None:
+            streets = [(1.0, other) for other in range(len(self.streets))]
+        else:
+            streets = self.find_streets(street)
+
+        rows = []
+        for similarity, street in streets:
+            start, end = self.street_rows(street, number, over_under)
+            rows.extend((row, similarity) for row in range(start, end))
+        return rows
+
+    def nearest(self, x, y, count=1, distance=GRID_CELL_SIZE):
+        """returns up to count (distance, row) for the points nearest to
+        x, y and no farther than distance, nearest first
+        """
+        return self.grid.nearest(self.xs, self.ys, x, y, count, distance)
+
+    def record(self, row):
+        """returns the fields of a row as a dictionary of strings, plus
+        its x and y
+        """
+        strings = self.strings
+        fields = dict((field, strings[column[row]])
+                      for field, column in self.columns.items())
+        fields[NUMBER_FIELD] = str(self.numbers[row])
+        fields['x'] = self.xs[row]
+        fields['y'] = self.ys[row]
+        return fields
+
+def main(args):
+    path = args[1] if len(args) > 1 else "shapefiles/address_point/address_point.shp"
+
+    start = time.time()
+    index = AddressIndex.load(path)
+    print("{} points on {} streets, {} strings, in {:.1f}s".format(
+        len(index), len(index.streets), len(index.strings), time.time() - start))
+
+    if len(args) > 3:
+        start = time.time()
+        rows = index.find(int(args[2]), args[3].upper(), 20)
+        print("{} candidates in {:.3f}ms".format(len(rows),
+                                                  (time.time() - start) * 1000))
+        for row, similarity in rows:
+            print(similarity, index.record(row))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,187 @@
+import os, sys, mmap, time, struct
+from array import array
+
+import addressindex
+
+MAGIC = b'ATXADDR\0'
+
+VERSION = 2
+
+# magic, version, number of sections, grid cell size, grid origin x and
+# y, grid columns, and the modification time and size of the shapefile
+# the store was built from
+HEADER = struct.Struct('<8sIIdddqdq')
+
+# name, typecode, offset and length in bytes of each section
+SECTION = struct.Struct('<16s1s7xQQ')
+
+# sections start on 8 byte boundaries, so they can be cast in place
+ALIGNMENT = 8
+
+class StringTable(object):
+    """the interned strings of the store, decoded when asked for"""
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]],
+                   'utf-8')
+
+def source_stamp(source_path):
+    stat = os.stat(source_path)
+    return stat.st_mtime, stat.st_size
+
+def encode_strings(strings):
+    """returns the offsets and utf-8 data of a StringTable of strings"""
+    data = bytearray()
+    offsets = [0]
+    for string in strings:
+        data += string.encode('utf-8')
+        offsets.append(len(data))
+    return offsets, data
+
+def sections(index):
+    """returns the (name, typecode, values) of the arrays of the index"""
+    string_offsets, string_data = encode_strings(index.strings)
+    trigram_index = index.trigram_index
+    gram_offsets, gram_data = encode_strings(trigram_index.grams)
+
+    grid = index.grid
+    result = [
+        ('string_offsets', 'q', string_offsets),
+        ('string_data', 'B', string_data),
+        ('streets', 'q', index.streets),
+        ('street_starts', 'q', index.street_starts),
+        ('numbers', 'q', index.numbers),
+        ('xs', 'd', index.xs),
+        ('ys', 'd', index.ys),
+        ('cell_keys', 'q', grid.cell_keys),
+        ('cell_starts', 'q', grid.cell_starts),
+        ('cell_rows', 'q', grid.cell_rows),
+        ('gram_offsets', 'q', gram_offsets),
+        ('gram_data', 'B', gram_data),
+        ('gram_starts', 'q', trigram_index.starts),
+        ('gram_streets', 'q', trigram_index.streets),
+        ('street_grams', 'q', trigram_index.counts),
+    ]
+    for field in addressindex.STRING_FIELDS:
+        result.append((field, 'q', index.columns[field]))
+    return result
+
+def write(index, path, source_path):
+    """writes the index to the store at path, recording the shapefile
+    it was built from. written then renamed, so workers opening the
+    store never see half of it
+    """
+    parts = []
+    for name, typecode, values in sections(index):
+        if typecode == 'B':
+            content = bytes(values)
+        else:
+            content = array(typecode, values).tobytes()
+        parts.append((name, typecode, content))
+
+    mtime, size = source_stamp(source_path)
+    grid = index.grid
+    header = HEADER.pack(MAGIC, VERSION, len(parts), grid.cell_size,
+                         grid.min_x, grid.min_y, grid.columns, mtime, size)
+
+    offset = HEADER.size + SECTION.size * len(parts)
+    directory = []
+    for name, typecode, content in parts:
+        offset += -offset % ALIGNMENT
+        directory.append(SECTION.pack(name.encode('ascii'),
+                                      typecode.encode('ascii'),
+                                      offset, len(content)))
+        offset += len(content)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(header)
+        for entry in directory:
+            file.write(entry)
+        for name, typecode, content in parts:
+            file.write(b'\0' * (-file.tell() % ALIGNMENT))
+            file.write(content)
+    os.rename(temp_path, path)
+
+def build(source_path, path):
+    """compiles the address point shapefile into the store at path"""
+    index = addressindex.AddressIndex.load(source_path)
+    write(index, path, source_path)
+    return index
+
+def is_current(path, source_path):
+    """returns whether the store exists and was built from the
+    shapefile as it is now
+    """
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(source_path):
+        return True
+
+    with open(path, 'rb') as file:
+        header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    fields = HEADER.unpack(header)
+    return (fields[0] == MAGIC and fields[1] == VERSION and
+            (fields[7], fields[8]) == source_stamp(source_path))
+
+def open_store(path):
+    """returns an AddressIndex whose arrays are views of the store at
+    path, mapped read only so every process shares the same pages.
+    nothing is built per process, the street and trigram lookups are
+    binary searches over the mapped sections
+    """
+    with open(path, 'rb') as file:
+        # the map keeps its own descriptor, the file can be closed
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, count, cell_size, min_x, min_y, columns,
+     mtime, size) = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise Exception("Not an address store: {}".format(path))
+    if version != VERSION:
+        raise Exception("Unsupported address store version: {}".format(version))
+
+    view = memoryview(mm)
+    arrays = {}
+    for number in range(count):
+        name, typecode, offset, length = SECTION.unpack_from(
+            mm, HEADER.size + SECTION.size * number)
+        name = name.rstrip(b'\0').decode('ascii')
+        arrays[name] = view[offset:offset + length].cast(typecode.decode('ascii'))
+
+    strings = StringTable(arrays['string_offsets'], arrays['string_data'])
+    grid = addressindex.SpatialGrid(cell_size, min_x, min_y, columns,
+                                    arrays['cell_keys'], arrays['cell_starts'],
+                                    arrays['cell_rows'])
+    trigram_index = addressindex.TrigramIndex(
+        StringTable(arrays['gram_offsets'], arrays['gram_data']),
+        arrays['gram_starts'], arrays['gram_streets'], arrays['street_grams'])
+    index = addressindex.AddressIndex(
+        strings, arrays['streets'], arrays['street_starts'], arrays['numbers'],
+        arrays['xs'], arrays['ys'],
+        dict((field, arrays[field]) for field in addressindex.STRING_FIELDS),
+        grid, trigram_index)
+    # the views need the map to stay open as long as the index is used
+    index.store = mm
+    return index
+
+def main(args):
+    source_path = (args[1] if len(args) > 1
+                   else "shapefiles/address_point/address_point.shp")
+    path = args[2] if len(args) > 2 else os.path.splitext(source_path)[0] + ".store"
+
+    start = time.time()
+    index = build(source_path, path)
+    print("wrote {} points on {} streets to {} in {:.1f}s".format(
+        len(index), len(index.streets), path, time.time() - start))
+
+if __name__ == "__main__":
+    main(sys.argv)
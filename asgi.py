@@ -0,0 +1,251 @@
+import io
+import os
+import re
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import server, transcode
+
+from django.utils.http import http_date
+
+# threads doing bundle index and image reads for the event loop
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 16))
+
+# requests past this many in flight are turned away with a 503
+ASGI_MAX_IN_FLIGHT = int(os.environ.get('ASGI_MAX_IN_FLIGHT', 512))
+
+executor = ThreadPoolExecutor(ASGI_WORKERS)
+
+tile_pattern = re.compile(
+    r'^/GIS/REST/MapTiled/GreyScale/MapServer/tile/([0-9]+)/([0-9]+)/([0-9]+)')
+
+service_pattern = re.compile(r'^/GIS/REST/MapTiled/GreyScale/MapServer/?$')
+
+def read_template(name):
+    with open(os.path.join(server.BASE_DIR, 'templates', name), 'rb') as f:
+        return f.read()
+
+SERVICE_DESCRIPTION_JSON = read_template('service_description.json')
+
+SERVICE_DESCRIPTION_HTML = read_template('service_description.html')
+
+in_flight = 0
+
+async def run(function, *args):
+    """runs function on the executor, off the event loop"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, function, *args)
+
+async def respond(send, status, body=b'', headers=()):
+    headers = [(name.encode('latin-1'), str(value).encode('latin-1'))
+               for name, value in headers]
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+def without_body(send):
+    """wraps send for a head request, the headers, content-length
+    included, go out as they would for a get but the body doesn't
+    """
+    async def send_headers(message):
+        if message['type'] == 'http.response.body':
+            message = dict(message, body=b'')
+        await send(message)
+    return send_headers
+
+def request_headers(scope):
+    return dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                for name, value in scope['headers'])
+
+def query_parameters(scope):
+    return parse_qs(scope.get('query_string', b'').decode('latin-1'))
+
+def etag_matches(etag, if_none_match):
+    if not if_none_match:
+        return False
+    quoted = '"{}"'.format(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == quoted:
+            return True
+    return False
+
+def tile_validators(lod, y, x, image_format):
+    validator = server.tile_validator(lod, y, x)
+    last_modified = http_date(validator[1]) if validator else None
+    return server.tile_etag(lod, y, x, image_format, validator), last_modified
+
+def tile_cache_headers(lod):
+    max_age = server.tile_max_age(lod)
+    return [('cache-control', 'public, max-age={}'.format(max_age)),
+            ('expires', http_date(time.time() + max_age))]
+
+async def tile(scope, lod, y, x, send):
+    """the same tile the wsgi tile view returns, with index and bundle
+    reads run on the executor
+    """
+    lod, y, x = int(lod), int(y), int(x)
+    headers = request_headers(scope)
+    image_format = server.choose_format(
+        query_parameters(scope).get('format', [''])[0], headers.get('accept', ''))
+
+    if image_format is None or lod > 100 or y > 10000000 or x > 10000000:
+        await respond(send, 400, b'Invalid Tile Request',
+                      [('content-type', 'text/plain')])
+        return
+
+    etag, last_modified = await run(tile_validators, lod, y, x, image_format)
+    validator_headers = []
+    if etag:
+        validator_headers.append(('etag', '"{}"'.format(etag)))
+    if last_modified:
+        validator_headers.append(('last-modified', last_modified))
+
+    if etag and etag_matches(etag, headers.get('if-none-match')):
+        await respond(send, 304, headers=validator_headers)
+        return
+
+    if not server.tile_exists(lod, y, x) and not (
+            server.OVERZOOM and server.overzoom_source(lod, y, x)):
+        if server.MISSING_TILE == 'blank':
+            await respond(send, 200, server.BLANK_TILE,
+                          [('content-type', 'image/png')] + validator_headers
+                          + tile_cache_headers(lod))
+        else:
+            await respond(send, 404, b'Tile Not Found',
+                          [('content-type', 'text/plain')] + tile_cache_headers(lod))
+        return
+
+    key = (lod, y, x)
+    image = server.tile_cache.get(key)
+    if image is None:
+        image = await run(server.tile_flight.do, key, server.load_tile,
+                          lod, y, x)
+    if image_format != transcode.DEFAULT_FORMAT:
+        image = await run(server.transcoder.get, key, image, image_format)
+
+    await respond(send, 200, image,
+                  [('content-type', transcode.content_type(image_format)),
+                   ('vary', 'Accept')] + validator_headers
+                  + tile_cache_headers(lod))
+
+async def service_description(scope, send):
+    if query_parameters(scope).get('f', [''])[0] == 'json':
+        await respond(send, 200, SERVICE_DESCRIPTION_JSON,
+                      [('content-type', 'application/json')])
+    else:
+        await respond(send, 200, SERVICE_DESCRIPTION_HTML,
+                      [('content-type', 'text/html; charset=utf-8')])
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    # wsgi paths are the raw bytes decoded as latin-1
+    path = scope['path'].encode('utf-8').decode('latin-1')
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+
+    return environ
+
+def call_wsgi(environ):
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = server.application(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+async def wsgi(scope, receive, send):
+    """everything else goes to the django application, on the executor"""
+    body = b''
+    more = True
+    while more:
+        message = await receive()
+        body += message.get('body', b'')
+        more = message.get('more_body', False)
+
+    status, headers, content = await run(call_wsgi, wsgi_environ(scope, body))
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'content-length']
+    await respond(send, status, content, headers)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    """asgi entry point, serving tiles and the service description on
+    the event loop and everything else through the wsgi application
+    """
+    global in_flight
+
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if scope['method'] == 'HEAD':
+        send = without_body(send)
+
+    if in_flight >= ASGI_MAX_IN_FLIGHT:
+        await respond(send, 503, b'Too Many Requests',
+                      [('content-type', 'text/plain'), ('retry-after', '1')])
+        return
+
+    # the counter is only touched from the event loop thread
+    in_flight += 1
+    try:
+        path = scope['path']
+        match = tile_pattern.match(path)
+        if match and scope['method'] in ('GET', 'HEAD'):
+            await tile(scope, match.group(1), match.group(2), match.group(3), send)
+        elif service_pattern.match(path) and scope['method'] in ('GET', 'HEAD'):
+            await service_description(scope, send)
+        else:
+            await wsgi(scope, receive, send)
+    finally:
+        in_flight -= 1
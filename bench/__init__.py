@@ -0,0 +1 @@
+"""benchmarks for tile serving, see bench.run"""
@@ -0,0 +1,99 @@
+import os, sys, zlib, struct, random, argparse
+from functools import lru_cache
+
+import unbundle, manifest
+
+# first row and column of the generated area on the coarsest level, a
+# little before a bundle boundary so the area spans several bundles
+ORIGIN = 112
+
+def area(base_level, level, size):
+    """returns the first row, first column and side in tiles of the
+    generated area on level, which covers the same ground on every level
+    """
+    scale = 2 ** (level - base_level)
+    return ORIGIN * scale, ORIGIN * scale, size * scale
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+@lru_cache(maxsize=256)
+def grey_png(shade):
+    """returns a grey 256 x 256 png, without its end chunk"""
+    rows = (b'\x00' + bytes([shade]) * 256) * 256
+    return (b'\x89PNG\r\n\x1a\n' +
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', 256, 256, 8, 0, 0, 0, 0)) +
+            png_chunk(b'IDAT', zlib.compress(rows)))
+
+def png_tile(length, shade, generator):
+    """returns a grey png of about length bytes, padded out with a
+    private chunk that decoders skip
+    """
+    image = grey_png(shade)
+    end = png_chunk(b'IEND', b'')
+
+    padding = length - len(image) - len(end) - 12
+    if padding > 0:
+        image += png_chunk(b'paDd',
+                           generator.getrandbits(padding * 8).to_bytes(padding, 'little'))
+    return image + end
+
+def generate(root, levels, size=32, min_bytes=500, max_bytes=4000,
+             sparsity=0.0, seed=0):
+    """writes synthetic bundles under root for each of levels, covering
+    a square of size by size tiles on the coarsest level and the same
+    ground on the finer ones. tiles are valid pngs between min_bytes
+    and max_bytes long, and sparsity is the fraction of them left out.
+    writes the manifest too and returns the list of (level, row, col)
+    written
+    """
+    generator = random.Random(seed)
+    base_level = min(levels)
+    written = []
+
+    for level in levels:
+        directory = os.path.join(root, "L%02d" % level)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        first_row, first_col, side = area(base_level, level, size)
+        bundles = {}
+        for row in range(first_row, first_row + side):
+            for col in range(first_col, first_col + side):
+                if generator.random() < sparsity:
+                    continue
+                length = generator.randint(min_bytes, max_bytes)
+                image = png_tile(length, generator.randrange(256), generator)
+                name = unbundle.bundle_name(row, col)
+                bundles.setdefault(name, {})[(row, col)] = image
+                written.append((level, row, col))
+
+        for name, tiles in bundles.items():
+            unbundle.write_bundle(os.path.join(directory, name), tiles)
+
+    manifest.build(root).save(os.path.join(root, "manifest.json"))
+    return written
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="write a synthetic compact cache to benchmark with")
+    parser.add_argument('root', nargs='?', default="files/")
+    parser.add_argument('--levels', default="2,3,4",
+                        help="comma separated levels, coarsest first")
+    parser.add_argument('--size', type=int, default=32,
+                        help="side of the area in tiles on the coarsest level")
+    parser.add_argument('--min-bytes', type=int, default=500)
+    parser.add_argument('--max-bytes', type=int, default=4000)
+    parser.add_argument('--sparsity', type=float, default=0.0,
+                        help="fraction of the tiles left empty")
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(args[1:])
+
+    levels = sorted(int(level) for level in options.levels.split(','))
+    written = generate(options.root, levels, options.size, options.min_bytes,
+                       options.max_bytes, options.sparsity, options.seed)
+    print("wrote {} tiles on levels {}".format(len(written), levels))
+
+if __name__ == "__main__":
+    main(sys.argv)
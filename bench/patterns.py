@@ -0,0 +1,71 @@
+from bench.generate import area
+
+# a viewport of rows by columns of tiles, about a 1024 x 1536 window
+VIEWPORT = (4, 6)
+
+def random_tiles(levels, size, count, generator):
+    """returns count tiles picked anywhere in the generated area on any
+    of the levels
+    """
+    base_level = min(levels)
+    tiles = []
+    for _ in range(count):
+        level = generator.choice(levels)
+        first_row, first_col, side = area(base_level, level, size)
+        tiles.append((level,
+                      first_row + generator.randrange(side),
+                      first_col + generator.randrange(side)))
+    return tiles
+
+def viewport(level, row, col):
+    rows, cols = VIEWPORT
+    return [(level, row + y, col + x) for y in range(rows) for x in range(cols)]
+
+def pan(levels, size, count, generator):
+    """returns count tiles requested by a viewport on the finest level
+    wandering one tile at a time, the whole viewport first then only
+    the tiles each step brings into view
+    """
+    level = max(levels)
+    first_row, first_col, side = area(min(levels), level, size)
+    rows, cols = VIEWPORT
+    row = first_row + (side - rows) // 2
+    col = first_col + (side - cols) // 2
+
+    tiles = viewport(level, row, col)
+    seen = set(tiles)
+    while len(tiles) < count:
+        step_row, step_col = generator.choice(((0, 1), (0, -1), (1, 0), (-1, 0)))
+        row = min(max(row + step_row, first_row), first_row + side - rows)
+        col = min(max(col + step_col, first_col), first_col + side - cols)
+        for tile in viewport(level, row, col):
+            if tile not in seen:
+                seen.add(tile)
+                tiles.append(tile)
+        # the viewport has been everywhere, start over
+        if len(seen) == side * side:
+            seen = set()
+    return tiles[:count]
+
+def zoom_burst(levels, size, count, generator):
+    """returns count tiles requested by zooming in on random places, a
+    viewport on each level from the coarsest to the finest
+    """
+    base_level = min(levels)
+    rows, cols = VIEWPORT
+    tiles = []
+    while len(tiles) < count:
+        y = generator.random()
+        x = generator.random()
+        for level in sorted(levels):
+            first_row, first_col, side = area(base_level, level, size)
+            row = first_row + int(y * max(side - rows, 0))
+            col = first_col + int(x * max(side - cols, 0))
+            tiles.extend(viewport(level, row, col))
+    return tiles[:count]
+
+PATTERNS = {
+    'random': random_tiles,
+    'pan': pan,
+    'zoom': zoom_burst,
+}
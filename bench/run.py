@@ -0,0 +1,229 @@
+import os, sys, io, json, time, random, shutil, tempfile, argparse
+
+# the repo modules are at the top level, and the benchmark runs from the
+# directory holding the generated files/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import unbundle
+from bench import generate, patterns
+
+# a change in throughput or latency past this fraction is a regression
+DEFAULT_THRESHOLD = 0.1
+
+def io_syscalls():
+    """returns the read and write system calls (syscr and syscw of
+    /proc/self/io) made by the process so far, or None where that isn't
+    available. open, mmap, fstat and the rest aren't counted, run the
+    benchmark under strace -c or perf stat for those
+    """
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(':') for line in file)
+    except (IOError, OSError):
+        return None
+    return int(counters['syscr']) + int(counters['syscw'])
+
+def rss():
+    """returns the resident set size of the process in bytes"""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+
+    import resource
+    # the peak, in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, fraction):
+    """returns the value at fraction of the sorted values"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(fetch, tiles):
+    """calls fetch(level, row, col) for each of tiles, returns the
+    throughput, the latency percentiles in milliseconds, the read and
+    write system calls per tile and the resident set size after
+    """
+    latencies = []
+    calls = io_syscalls()
+
+    start = time.perf_counter()
+    for level, row, col in tiles:
+        begin = time.perf_counter()
+        fetch(level, row, col)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+
+    if calls is not None:
+        calls = (io_syscalls() - calls) / float(len(tiles))
+
+    latencies.sort()
+    return {
+        'tiles': len(tiles),
+        'throughput': len(tiles) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'io_syscalls': calls,
+        'rss': rss(),
+    }
+
+def fetch_map_tile(level, row, col):
+    unbundle.get_map_tile(level, row, col)
+
+def wsgi_fetch():
+    """returns a fetch function requesting the tile from the server
+    application in process
+    """
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('ALLOWED_HOSTS', 'localhost')
+    os.environ.setdefault('DEBUG', 'off')
+    import server
+
+    def start_response(status, headers, exc_info=None):
+        if not status.startswith('200'):
+            raise Exception("Tile request failed: {}".format(status))
+
+    def fetch(level, row, col):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/GIS/REST/MapTiled/GreyScale/MapServer/tile/{}/{}/{}'
+                         .format(level, row, col),
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http',
+        }
+        result = server.application(environ, start_response)
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    return fetch
+
+TARGETS = {
+    'unbundle': lambda: fetch_map_tile,
+    'wsgi': wsgi_fetch,
+}
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """returns a list of (name, metric, baseline, result) for every
+    throughput that dropped or latency that grew by more than threshold
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append((name, 'throughput', before['throughput'],
+                                result['throughput']))
+        for metric in ('p50', 'p95', 'p99'):
+            if result[metric] > before[metric] * (1 + threshold):
+                regressions.append((name, metric, before[metric], result[metric]))
+    return regressions
+
+def report(results, baseline=None):
+    print("{:<18} {:>10} {:>8} {:>8} {:>8} {:>9} {:>8}".format(
+        'target/pattern', 'tiles/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'r/w calls', 'rss MB'))
+    for name, result in sorted(results.items()):
+        calls = result.get('io_syscalls')
+        print("{:<18} {:>10.0f} {:>8.3f} {:>8.3f} {:>8.3f} {:>9} {:>8.1f}".format(
+            name, result['throughput'], result['p50'], result['p95'],
+            result['p99'], '-' if calls is None else '{:.2f}'.format(calls),
+            result['rss'] / 1024.0 / 1024.0))
+        if baseline and name in baseline:
+            before = baseline[name]
+            print("{:<18} {:>+9.1f}% {:>+7.1f}% {:>+7.1f}% {:>+7.1f}%".format(
+                '  vs baseline',
+                (result['throughput'] / before['throughput'] - 1) * 100,
+                (result['p50'] / before['p50'] - 1) * 100,
+                (result['p95'] / before['p95'] - 1) * 100,
+                (result['p99'] / before['p99'] - 1) * 100))
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="benchmark tile reads against a synthetic compact cache")
+    parser.add_argument('--workdir', default=None,
+                        help="directory to generate files/ in, a temporary "
+                             "one by default. an existing files/ is reused")
+    parser.add_argument('--levels', default="2,3,4")
+    parser.add_argument('--size', type=int, default=32,
+                        help="side of the area in tiles on the coarsest level")
+    parser.add_argument('--min-bytes', type=int, default=500)
+    parser.add_argument('--max-bytes', type=int, default=4000)
+    parser.add_argument('--sparsity', type=float, default=0.0)
+    parser.add_argument('--count', type=int, default=5000,
+                        help="tiles requested per pattern")
+    parser.add_argument('--targets', default="unbundle,wsgi")
+    parser.add_argument('--patterns', default="random,pan,zoom")
+    parser.add_argument('--warm', action='store_true',
+                        help="request every tile once before measuring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write the results to this json file")
+    parser.add_argument('--compare', help="compare with results saved earlier")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    options = parser.parse_args(args[1:])
+
+    levels = sorted(int(level) for level in options.levels.split(','))
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)['results']
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='tilebench')
+    if options.save:
+        options.save = os.path.abspath(options.save)
+    os.chdir(workdir)
+
+    try:
+        if not os.path.isdir("files"):
+            start = time.time()
+            written = generate.generate("files/", levels, options.size,
+                                        options.min_bytes, options.max_bytes,
+                                        options.sparsity, options.seed)
+            print("generated {} tiles in {:.1f}s".format(len(written),
+                                                         time.time() - start))
+
+        results = {}
+        for target in options.targets.split(','):
+            fetch = TARGETS[target]()
+            for pattern in options.patterns.split(','):
+                tiles = patterns.PATTERNS[pattern](
+                    levels, options.size, options.count,
+                    random.Random(options.seed))
+                if options.warm:
+                    for tile in tiles:
+                        fetch(*tile)
+                results[target + '/' + pattern] = measure(fetch, tiles)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    report(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as file:
+            json.dump({'options': vars(options), 'results': results}, file,
+                      indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, options.threshold)
+        for name, metric, before, after in regressions:
+            print("regression: {} {} {:.3f} -> {:.3f}".format(name, metric,
+                                                              before, after))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,56 @@
+import threading
+
+DEFAULT_TIMEOUT = 30
+
+class CoalesceTimeout(Exception):
+    pass
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """runs at most one call per key at a time. callers that ask for a
+    key while a call for it is in flight wait for that call and share
+    its result, or its exception, instead of starting their own
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        """returns function(*args, **kwargs), computed once for all the
+        concurrent callers with the same key. waiting callers raise
+        CoalesceTimeout if the call takes longer than the timeout
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if leader:
+            try:
+                call.result = function(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+            return call.result
+
+        if not call.event.wait(self.timeout):
+            raise CoalesceTimeout("Timed out waiting for {!r}".format(key))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,238 @@
+import os, sys, csv, json, time, argparse
+from collections import deque, OrderedDict
+from multiprocessing import Pool
+
+import locator
+
+# the columns added to each row of output
+RESULT_FIELDS = ('match_address', 'x', 'y', 'score', 'status')
+
+BATCH_SIZE = 500
+
+# batches in flight on the pool at a time
+WINDOW = 16
+
+# distinct addresses whose results are kept for rows further on, on top
+# of the ones the batches in flight still need
+CACHE_SIZE = 100000
+
+PROGRESS_INTERVAL = 10
+
+# placeholder for a key submitted in a batch that hasn't finished
+_PENDING = object()
+
+def init_worker():
+    """warms up the parser and address index of a worker process. the
+    index is loaded in the parent, so forked workers already share it.
+    never raises, the pool would start a failing worker again forever
+    """
+    try:
+        locator.preload()
+    except Exception:
+        pass
+
+def geocode(address):
+    """returns the best match for one normalized address as a dictionary
+    of RESULT_FIELDS, in EPSG:2277
+    """
+    try:
+        candidates = locator.find_candidates(address)
+    except Exception as e:
+        return {'status': 'error: {}'.format(e)}
+
+    if not candidates:
+        return {'status': 'unmatched'}
+
+    best = candidates[0]
+    return {'match_address': best['address'],
+            'x': best['location']['x'],
+            'y': best['location']['y'],
+            'score': best['score'],
+            'status': 'matched'}
+
+def geocode_many(addresses, epsg=locator.EPSG_2277):
+    """returns (address, result) for each address, with the matches of
+    all of them reprojected to epsg in one go
+    """
+    results = [(address, geocode(address)) for address in addresses]
+
+    matched = [result for address, result in results if 'x' in result]
+    points = locator.transform_points([(result['x'], result['y'])
+                                       for result in matched],
+                                      locator.EPSG_2277, epsg)
+    for result, (x, y) in zip(matched, points):
+        result['x'] = x
+        result['y'] = y
+    return results
+
+class Progress(object):
+    def __init__(self, stream=sys.stderr, interval=PROGRESS_INTERVAL):
+        self.stream = stream
+        self.interval = interval
+        self.start = time.time()
+        self.reported = self.start
+        self.rows = 0
+        self.unique = 0
+
+    def update(self, rows, unique, force=False):
+        self.rows += rows
+        self.unique += unique
+        now = time.time()
+        if force or now - self.reported >= self.interval:
+            self.reported = now
+            elapsed = max(now - self.start, 1e-9)
+            self.stream.write("{} rows, {} unique, {:.0f} rows/s\n".format(
+                self.rows, self.unique, self.rows / elapsed))
+            self.stream.flush()
+
+def geocode_rows(rows, column, workers=None, batch_size=BATCH_SIZE,
+                 window=WINDOW, progress=None, epsg=locator.EPSG_2277):
+    """yields (row, result) for each row, in order, with result the
+    dictionary of RESULT_FIELDS for the address in row[column], its x
+    and y in epsg. addresses are normalized and each distinct one is
+    geocoded once, on a pool of worker processes, with at most window
+    batches of batch_size rows in flight
+    """
+    # the batches in flight use at most window * batch_size keys, all
+    # used more recently than any other, so room for them on top of
+    # CACHE_SIZE means none is evicted before its batch finishes
+    cache_size = CACHE_SIZE + window * batch_size
+    results = OrderedDict()
+    pending = deque()
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def submit(batch):
+        keys = []
+        unique = []
+        for row in batch:
+            try:
+                key = locator.normalize(row.get(column) or '')
+            except Exception:
+                key = ''
+            keys.append(key)
+            if key in results:
+                results.move_to_end(key)
+            else:
+                results[key] = _PENDING
+                unique.append(key)
+        return keys, unique
+
+    def finish():
+        batch, keys, unique, result = pending.popleft()
+        for key, value in result.get():
+            results[key] = value
+        while len(results) > cache_size:
+            results.popitem(last=False)
+        if progress is not None:
+            progress.update(len(batch), len(unique))
+        return [(row, results[key]) for row, key in zip(batch, keys)]
+
+    # fails here, before any worker is started, if there is no address data
+    locator.get_address_index()
+
+    pool = Pool(workers, initializer=init_worker)
+    try:
+        for batch in batches():
+            keys, unique = submit(batch)
+            pending.append((batch, keys, unique,
+                            pool.apply_async(geocode_many, (unique, epsg))))
+            while len(pending) >= window:
+                for item in finish():
+                    yield item
+        while pending:
+            for item in finish():
+                yield item
+    finally:
+        pool.terminate()
+        pool.join()
+
+def read_rows(file, input_format):
+    """returns the input fields and an iterator of rows as dictionaries"""
+    if input_format == 'csv':
+        reader = csv.DictReader(file)
+        return list(reader.fieldnames or []), reader
+    return None, (json.loads(line) for line in file if line.strip())
+
+def guess_format(path, default='csv'):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json', '.ndjson'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    return default
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="geocode every address in a csv or jsonl file, writing "
+                    "the rows with their best match in the same order")
+    parser.add_argument('input', help="csv with a header or jsonl, - for stdin")
+    parser.add_argument('output', nargs='?', default='-',
+                        help="csv or jsonl, - for stdout")
+    parser.add_argument('--column', default='address',
+                        help="the column or key holding the address")
+    parser.add_argument('--input-format', choices=('csv', 'jsonl'))
+    parser.add_argument('--output-format', choices=('csv', 'jsonl'))
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes, defaults to the cpu count")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--out-sr', type=int, default=locator.EPSG_2277,
+                        help="epsg code of the x and y written out")
+    options = parser.parse_args(args[1:])
+
+    # before the output is opened, so a missing index doesn't truncate it
+    try:
+        locator.get_address_index()
+    except Exception as e:
+        sys.exit("Could not load the address data: {}".format(e))
+
+    input_format = options.input_format or guess_format(options.input)
+    output_format = (options.output_format or
+                     guess_format(options.output, input_format))
+
+    source = sys.stdin if options.input == '-' else open(options.input, newline='')
+    target = sys.stdout if options.output == '-' else open(options.output, 'w',
+                                                           newline='')
+    progress = Progress()
+
+    try:
+        fields, rows = read_rows(source, input_format)
+        results = geocode_rows(rows, options.column, options.workers,
+                               options.batch_size, progress=progress,
+                               epsg=options.out_sr)
+
+        if output_format == 'csv':
+            writer = None
+            for row, result in results:
+                if writer is None:
+                    names = fields or list(row)
+                    writer = csv.DictWriter(target, names + [
+                        field for field in RESULT_FIELDS if field not in names],
+                        extrasaction='ignore')
+                    writer.writeheader()
+                output = dict(row)
+                output.update(result)
+                writer.writerow(output)
+        else:
+            for row, result in results:
+                output = dict(row)
+                output.update(result)
+                target.write(json.dumps(output) + '\n')
+
+        progress.update(0, 0, force=True)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
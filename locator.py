@@ -1,5 +1,7 @@
-import os, sys, re, usaddress, logging, mappings
-from osgeo import ogr, osr
+import os, sys, re, copy, json, math, threading, usaddress, logging, mappings, coalesce, metrics
+import addressindex, addressstore
+from functools import lru_cache
+from osgeo import osr
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -36,6 +38,11 @@ class Messages(object):
 
 STREET_ADDRESS = "Street Address"
 
+class AddressError(Exception):
+    """the address string can't be parsed into something to search for,
+    it has no candidates
+    """
+
 field_map = {
     USFields.AddressNumber             : ATXFields.address,
     USFields.AddressNumberSuffix       : ATXFields.address_fr,
@@ -54,6 +61,11 @@ EPSG_2277 = 2277
 
 ADDRESS_OVER_UNDER = 20
 
+def _stage_seconds(stage):
+    return metrics.histogram('geocode_stage_seconds',
+                             "time spent in each stage of geocoding",
+                             stage=stage)
+
 def _sanitize(user_input):
     """strip unwated characters from user input
     """
@@ -64,6 +76,42 @@ def _sanitize(user_input):
     clean = re.sub(r"[;\(\)\[\]\<\>=:*\%\$\`\?]", "", user_input)
     return clean
 
+# the tables of mappings, with a pattern that has to follow a word for it
+# to be translated. a pre-type like FARM is only one before a route
+# number, and a pre-direction only one before at least two more words, so
+# the NORTH of NORTH ST stays the street name
+TRANSLATION_TABLES = (
+    (mappings.STREET_PRE_TYPE_TRANS, ''),
+    (mappings.STREET_PRE_TYPE_TROUBLE, r'(?= [0-9])'),
+    (mappings.STREET_POST_TYPE_TRANS, ''),
+    (mappings.POST_DIR_TRANS, ''),
+    (mappings.STREET_PRE_DIR_TRANS, r'(?= [^ ]+ [^ ])'),
+)
+
+def _compile_translations(tables):
+    """returns the translations of all the tables as one dictionary and
+    one pattern matching any of them as whole words, longest first so
+    FARM TO MARKET wins over FARM
+    """
+    translations = {}
+    alternatives = []
+    for table, context in tables:
+        for word, translation in table.items():
+            if translations.get(word, translation) != translation:
+                raise Exception("Conflicting translations for {}".format(word))
+            translations[word] = translation
+            alternatives.append((word, re.escape(word) + context))
+
+    alternatives.sort(key=lambda alternative: len(alternative[0]), reverse=True)
+    pattern = re.compile(r"(?<![A-Z0-9])(?:{})(?![A-Z0-9])".format(
+        '|'.join(alternative for word, alternative in alternatives)))
+    return translations, pattern
+
+_translations, _translation_pattern = _compile_translations(TRANSLATION_TABLES)
+
+def _translate(match):
+    return _translations[match.group(0)]
+
 def _pre_hack(address_string):
     """find and replace some stuff, hopefully won't be necessary
     after training
@@ -71,28 +119,26 @@ def _pre_hack(address_string):
     if not type(address_string) is str:
         raise TypeError(Messages.str_req)
 
-    address_string = address_string.upper()
-    words = address_string.split(' ')
-    for word in words:
-        if word in mappings.STREET_PRE_TYPE_TRANS.keys():
-            address_string = address_string.replace(word, mappings.STREET_PRE_TYPE_TRANS[word])
-        if word in mappings.STREET_POST_TYPE_TRANS.keys():
-            address_string = address_string.replace(word, mappings.STREET_POST_TYPE_TRANS[word])
-        if word in mappings.POST_DIR_TRANS.keys():
-            address_string = address_string.replace(word, mappings.POST_DIR_TRANS[word])
+    address_string = ' '.join(address_string.upper().split())
 
+    # a translation can make another, COUNTY ROAD becomes COUNTY RD then CR
+    for _ in range(3):
+        translated = _translation_pattern.sub(_translate, address_string)
+        if translated == address_string:
+            break
+        address_string = translated
     return address_string
 
 def _translate_to_atx(address_parts):
     """takes usfields tuple and returns atx dict
     """
     if not len(address_parts) == 2:
-        raise Exception(Messages.bad_results)
+        raise AddressError(Messages.bad_results)
 
     result_type = address_parts[1]
 
     if not result_type == STREET_ADDRESS:
-        raise Exception(Messages.bad_string)
+        raise AddressError(Messages.bad_string)
 
     ordered_dict = address_parts[0]
     atx_address_parts = {}
@@ -112,7 +158,7 @@ def _post_hack(atx_address_parts):
     won't be necessary after training
     """
 
-    print atx_address_parts
+    logger.debug("%s", atx_address_parts)
 
     try:
         if atx_address_parts[ATXFields.street_nam] == '1/2':
@@ -120,93 +166,94 @@ def _post_hack(atx_address_parts):
             atx_address_parts[ATXFields.street_nam] = name
             del atx_address_parts[ATXFields.prefix_dir]
     except Exception as e:
-        logging.debug(e.message)
+        logger.debug(e)
 
     return atx_address_parts
 
+PARSE_CACHE_SIZE = 10000
+
+@metrics.timed(_stage_seconds('parse'))
 def _parse(address_string):
     """parses address string into atx address parts,
     returns list
     """
-    if not type(address_string) is str:
-        raise TypeError(Messages.str_req)
+    # a copy, _post_hack and callers may change it
+    return dict(_parse_normalized(normalize(address_string)))
 
-    address_string = _sanitize(address_string)
-    address_string = _pre_hack(address_string)
-    address_parts = usaddress.tag(address_string)
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_normalized(address_string):
+    try:
+        address_parts = usaddress.tag(address_string)
+    except usaddress.RepeatedLabelError:
+        raise AddressError(Messages.bad_string)
     address_parts = _translate_to_atx(address_parts)
     address_parts = _post_hack(address_parts)
     return address_parts
 
-def _construct_query(address_parts):
-    """constructs sql query from address parts,
-    returns string
-    """
-    if not type(address_parts) is dict:
-        raise TypeError(Messages.dict_req)
-
-    clause_list = []
+# the address index compiled by addressstore.py, rebuilt whenever the
+# shapefile changes
+ADDRESS_STORE_PATH = os.path.splitext(ADDRESS_FILE_PATH)[0] + ".store"
 
-    for key, value in address_parts.items():
-        if key == ATXFields.address:
-            value = int(value)
-            low = value - ADDRESS_OVER_UNDER
-            high = value + ADDRESS_OVER_UNDER
-            clause_list.append("{0} > {1} AND {0} < {2}"
-                                .format(key, low, high))
-        elif key == ATXFields.street_nam:
-            clause_list.append("{} LIKE '%{}%'".format(key, value))
-        else:
-            #clause_list.append("{} = '{}'".format(key, value))
-            pass
-
-    field_list = [field for field in dir(ATXFields) if not field.startswith('_')]
-
-    query = ("SELECT OGR_GEOM_WKT, %s FROM address_point WHERE " %
-             ', '.join(field_list))
-
-    if len(clause_list) <= 0:
-        raise Exception(Messages.bad_results)
-
-    query += clause_list[0]
-
-    for clause in clause_list[1:]:
-        query += " and " + clause
+def _open_address_store():
+    """returns the address index mapped from the store, or None if
+    there is no store built from the shapefile as it is now
+    """
+    if not addressstore.is_current(ADDRESS_STORE_PATH, ADDRESS_FILE_PATH):
+        if os.path.exists(ADDRESS_STORE_PATH):
+            logger.warning("%s is older than %s, rebuild it with addressstore.py",
+                           ADDRESS_STORE_PATH, ADDRESS_FILE_PATH)
+        return None
 
-    # doesn't work with semicolon
-    # so don't do this: query += ";"
+    try:
+        return addressstore.open_store(ADDRESS_STORE_PATH)
+    except Exception as e:
+        logger.warning("Could not open %s: %s", ADDRESS_STORE_PATH, e)
+        return None
 
-    return query
+_address_index = _open_address_store()
+_address_index_lock = threading.Lock()
 
-def _query_db(query):
-    """executes sql query against data in shapefile
+def get_address_index():
+    """returns the address index, mapped from the store when there is
+    one, or loaded from the shapefile the first time
     """
-    if not type(query) is str:
-        raise TypeError("string required")
-
-    if not os.path.exists(ADDRESS_FILE_PATH):
-        raise Exception("Invalid path, shapefile does not exist")
-
-    driver = ogr.GetDriverByName(OGR_SHP_DRIVER)
-    data_source = driver.Open(ADDRESS_FILE_PATH, 0)
+    global _address_index
+    with _address_index_lock:
+        if _address_index is None:
+            if not os.path.exists(ADDRESS_FILE_PATH):
+                raise Exception("Invalid path, shapefile does not exist")
+            _address_index = addressindex.AddressIndex.load(ADDRESS_FILE_PATH)
+        return _address_index
+
+@metrics.timed(_stage_seconds('query'))
+def _query_index(address_parts):
+    """finds the address points on the street, or the streets most like
+    it, with a number within ADDRESS_OVER_UNDER of the one asked for,
+    returns a list of fields
+    """
+    if not type(address_parts) is dict:
+        raise TypeError(Messages.dict_req)
 
-    layer = data_source.ExecuteSQL(query)
+    number = address_parts.get(ATXFields.address)
+    street = address_parts.get(ATXFields.street_nam)
+    if number is None and street is None:
+        raise AddressError(Messages.bad_results)
 
-    if not layer:
-        raise Exception(Messages.bad_query)
+    if number is not None:
+        try:
+            number = int(number)
+        except ValueError:
+            raise AddressError(Messages.bad_results)
 
-    address_candidates = []
-    feature = layer.GetNextFeature()
-    while feature:
-        fields = {}
-        for field_index in range(feature.GetFieldCount()):
-            key = feature.GetFieldDefnRef(field_index).GetName()
-            value = feature.GetFieldAsString(field_index)
-            fields[key] = value
-        address_candidates.append(fields)
-        feature = layer.GetNextFeature()
-    return address_candidates
+    index = get_address_index()
+    candidates = []
+    for row, similarity in index.find(number, street, ADDRESS_OVER_UNDER):
+        candidate = index.record(row)
+        candidate['similarity'] = similarity
+        candidates.append(candidate)
+    return candidates
 
+@metrics.timed(_stage_seconds('score'))
 def _score_candidates(candidates, address_parts):
     threshold_candidates = []
     for candidate in candidates:
@@ -223,6 +270,10 @@ def _score_candidates(candidates, address_parts):
 
                 score += ((ADDRESS_OVER_UNDER - difference) * (10/float(ADDRESS_OVER_UNDER)))
 
+            elif key == ATXFields.street_nam:
+                # misspelt names match similar streets, for less
+                score += 10 * candidate.get('similarity', 1.0)
+
             elif address_parts[key] in candidate[ATXFields.full_stree]:
                 score += 10
 
@@ -235,18 +286,68 @@ def _score_candidates(candidates, address_parts):
 
     return threshold_candidates
 
-def _reproject(features, epsg):
-    # this may help
-    # https://pcjericks.github.io/py-gdalogr-cookbook/projection.html
-    return features
+# esri wkids of the spatial references that have one, by epsg code
+ESRI_WKIDS = {EPSG_2277: 102739, 3857: 102100}
 
-def _jsonify(address_candidates):
-    """returns json string from list of address candidates
-    """
-    #if not type(address_candidates) is list:
-    #    raise TypeError("list required")
+def spatial_reference(epsg):
+    """returns the arcgis json spatial reference of an epsg code"""
+    return {"wkid": ESRI_WKIDS.get(epsg, epsg), "latestWkid": epsg}
+
+# transformations are not safe to share between threads, each thread
+# keeps its own, built once per pair of epsg codes
+_transformations = threading.local()
 
-    spatialReference = {"wkid": 102739,"latestWkid": 2277}
+def get_transformation(source, target):
+    """returns the osr transformation from one epsg code to another,
+    taking and giving x, y whatever the axis order of the definitions
+    """
+    cache = getattr(_transformations, 'cache', None)
+    if cache is None:
+        cache = _transformations.cache = {}
+
+    transformation = cache.get((source, target))
+    if transformation is None:
+        references = []
+        for epsg in (source, target):
+            reference = osr.SpatialReference()
+            if reference.ImportFromEPSG(int(epsg)) != 0:
+                raise Exception("Unknown spatial reference: {}".format(epsg))
+            # gdal 3 follows the authority, latitude first for 4326
+            if hasattr(reference, 'SetAxisMappingStrategy'):
+                reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            references.append(reference)
+        transformation = osr.CoordinateTransformation(*references)
+        cache[(source, target)] = transformation
+    return transformation
+
+def transform_points(points, source, target):
+    """returns the list of (x, y) points transformed from one epsg code
+    to another, in one call
+    """
+    if source == target or not points:
+        return list(points)
+    transformed = get_transformation(source, target).TransformPoints(
+        [(float(x), float(y)) for x, y in points])
+    return [(point[0], point[1]) for point in transformed]
+
+def reproject(candidates, epsg):
+    """moves the locations of the candidates from EPSG:2277 to epsg"""
+    points = transform_points([(candidate['location']['x'],
+                                candidate['location']['y'])
+                               for candidate in candidates],
+                              EPSG_2277, epsg)
+    for candidate, (x, y) in zip(candidates, points):
+        candidate['location'] = {'x': x, 'y': y}
+    return candidates
+
+# the fields of an address point that can be asked for as attributes
+OUT_FIELDS = (ATXFields.address,) + addressindex.STRING_FIELDS
+
+def _format_candidates(address_candidates, out_fields=()):
+    """returns the scored address candidates as the candidates of an
+    arcgis geocode response, best first, with the out_fields of each
+    as its attributes
+    """
     candidates = []
 
     for candidate in address_candidates:
@@ -254,47 +355,137 @@ def _jsonify(address_candidates):
         fields = {}
         fields['address'] = candidate['full_stree']
 
-        wkt = candidate['OGR_GEOM_WKT']
-        point = ogr.CreateGeometryFromWkt(wkt)
-        x = point.GetX()
-        y = point.GetY()
-
         location = {}
-        location['x'] = x
-        location['y'] = y
+        location['x'] = candidate['x']
+        location['y'] = candidate['y']
 
         fields['location'] = location
         fields['score'] = candidate['score']
 
-        attributes = {}
+        attributes = dict((field, candidate[field]) for field in out_fields
+                          if field in candidate)
 
         fields['attributes'] = attributes
 
         candidates.append(fields)
 
-    ordered_candidates = sorted(candidates, key=lambda t: t['score'], reverse=True)
+    return sorted(candidates, key=lambda t: t['score'], reverse=True)
 
-    fortheweb = {'spatialReference' : spatialReference,
-                 'candidates' : ordered_candidates}
-
-    return repr(fortheweb).replace("\'","\"")
+@metrics.timed(_stage_seconds('jsonify'))
+def _jsonify(candidates, epsg=EPSG_2277):
+    """returns json string from list of formatted candidates
+    """
+    return json.dumps({'spatialReference': spatial_reference(epsg),
+                       'candidates': candidates})
 
-def locate(address_string, epsg=EPSG_2277):
-    """returns json address candidates given address string
+def normalize(address_string):
+    """returns the address string as it will be searched for, addresses
+    that normalize the same find the same candidates
     """
     if not type(address_string) is str:
         raise TypeError(Messages.str_req)
 
+    return _pre_hack(_sanitize(address_string))
+
+def find_candidates(address_string, epsg=EPSG_2277, out_fields=(),
+                    max_locations=None):
+    """returns the candidates for the address string as a list of
+    dictionaries with an address, location (in epsg), score and
+    attributes (the out_fields of the address point), best first and
+    at most max_locations of them. raises AddressError if the address
+    string can't be parsed
+    """
     address_parts = _parse(address_string)
-    query = _construct_query(address_parts)
-    address_candidates = _query_db(query)
+    address_candidates = _query_index(address_parts)
     scored_candidates = _score_candidates(address_candidates, address_parts)
-    json_result = _jsonify(scored_candidates)
+    candidates = _format_candidates(scored_candidates, out_fields)
+    if max_locations is not None:
+        candidates = candidates[:max_locations]
+    return reproject(candidates, epsg)
+
+def preload():
+    """loads the address index and the parser ahead of the first
+    request, returns False if the address data isn't there
+    """
+    try:
+        get_address_index()
+    except Exception as e:
+        logger.warning("Address data not loaded: %s", e)
+        return False
 
-    #if not epsg == EPSG_2277:
-    #    results = reproject(results, epsg)
+    # the tagger loads its model on first use
+    usaddress.tag("1 MAIN ST")
+    return True
 
-    return json_result
+locate_flight = coalesce.SingleFlight()
+
+def locate(address_string, epsg=EPSG_2277):
+    """returns json address candidates given address string,
+    concurrent calls for the same address share one search
+    """
+    if not type(address_string) is str:
+        raise TypeError(Messages.str_req)
+
+    return locate_flight.do((address_string, epsg), _locate,
+                            address_string, epsg)
+
+def _locate(address_string, epsg=EPSG_2277):
+    """parses, queries and scores, see locate
+    """
+    return _jsonify(find_candidates(address_string, epsg), epsg)
+
+candidates_flight = coalesce.SingleFlight()
+
+def coalesced_candidates(address_string, epsg=EPSG_2277, out_fields=(),
+                         max_locations=None):
+    """returns find_candidates for the address string, concurrent calls
+    for addresses that normalize the same share one search. the result
+    is a copy the caller can change
+    """
+    key = (normalize(address_string), epsg, tuple(out_fields), max_locations)
+    candidates = candidates_flight.do(key, find_candidates, address_string,
+                                      epsg, out_fields, max_locations)
+    return copy.deepcopy(candidates)
+
+# how far from the point, in feet, and how many addresses reverse
+# geocoding returns by default
+REVERSE_DISTANCE = 330.0
+
+REVERSE_COUNT = 1
+
+@metrics.timed(_stage_seconds('reverse'))
+def find_nearest(x, y, count=REVERSE_COUNT, distance=REVERSE_DISTANCE,
+                 epsg=EPSG_2277, location_epsg=EPSG_2277):
+    """returns the count address points nearest to x, y (in
+    location_epsg) and within distance feet as a list of dictionaries
+    with an address, location (in epsg), distance and attributes,
+    nearest first
+    """
+    (x, y), = transform_points([(x, y)], location_epsg, EPSG_2277)
+    # a point the projection can't represent is near nothing
+    if not (math.isfinite(x) and math.isfinite(y)):
+        return []
+
+    index = get_address_index()
+    candidates = []
+    for point_distance, row in index.nearest(float(x), float(y), count,
+                                             float(distance)):
+        candidate = index.record(row)
+        candidates.append({
+            'address': candidate[ATXFields.full_stree],
+            'location': {'x': candidate['x'], 'y': candidate['y']},
+            'distance': point_distance,
+            'attributes': {},
+        })
+    return reproject(candidates, epsg)
+
+def reverse_geocode(x, y, count=REVERSE_COUNT, distance=REVERSE_DISTANCE,
+                    epsg=EPSG_2277, location_epsg=EPSG_2277):
+    """returns json of the address points nearest to x, y, see
+    find_nearest
+    """
+    return _jsonify(find_nearest(x, y, count, distance, epsg, location_epsg),
+                    epsg)
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
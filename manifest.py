@@ -0,0 +1,153 @@
+import os, sys, re, json, zlib, base64
+
+import unbundle
+
+MANIFEST_VERSION = 1
+
+MANIFEST_PATH = "files/manifest.json"
+
+BITMAP_SIZE = unbundle.TILES_PER_BUNDLE // 8
+
+level_pattern = re.compile(r"^L(\d+)$")
+bundle_pattern = re.compile(r"^(R[0-9a-fA-F]{4}C[0-9a-fA-F]{4})\.bundle$")
+
+class Manifest(object):
+    """which bundles exist, and which tiles in them are not empty,
+    for every level of the cache. each bundle has a bitmap with a bit
+    per tile, in the same (column major) order as the index file
+    """
+    def __init__(self, levels=None):
+        # level -> bundle name -> bitmap
+        self.levels = levels or {}
+
+    def has_bundle(self, level, row, column):
+        bundles = self.levels.get(int(level))
+        if not bundles:
+            return False
+        return unbundle.bundle_name(int(row), int(column)) in bundles
+
+    def has_tile(self, level, row, column):
+        bundles = self.levels.get(int(level))
+        if not bundles:
+            return False
+
+        row = int(row)
+        column = int(column)
+        bitmap = bundles.get(unbundle.bundle_name(row, column))
+        if bitmap is None:
+            return False
+
+        bit = ((column % unbundle.TILES_PER_SIDE) * unbundle.TILES_PER_SIDE
+               + row % unbundle.TILES_PER_SIDE)
+        return bool(bitmap[bit >> 3] & (1 << (bit & 7)))
+
+    def set_bundle(self, level, name, bitmap):
+        """records the bitmap of a bundle, or that it is gone if the
+        bitmap is None
+        """
+        bundles = self.levels.setdefault(int(level), {})
+        if bitmap is None:
+            bundles.pop(name, None)
+        else:
+            bundles[name] = bitmap
+
+    def save(self, path=MANIFEST_PATH):
+        levels = {}
+        for level, bundles in self.levels.items():
+            levels[str(level)] = dict(
+                (name, base64.b64encode(zlib.compress(bytes(bitmap)))
+                                 .decode('ascii'))
+                for name, bitmap in bundles.items())
+
+        content = {'version': MANIFEST_VERSION, 'levels': levels}
+
+        # write then rename so a running server never sees half a file
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(content, file, separators=(',', ':'), sort_keys=True)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path=MANIFEST_PATH):
+        with open(path) as file:
+            content = json.load(file)
+
+        if content.get('version') != MANIFEST_VERSION:
+            raise Exception("Unsupported manifest version: {}"
+                            .format(content.get('version')))
+
+        levels = {}
+        for level, bundles in content['levels'].items():
+            levels[int(level)] = dict(
+                (name, bytearray(zlib.decompress(base64.b64decode(bitmap))))
+                for name, bitmap in bundles.items())
+
+        return cls(levels)
+
+def scan_bundle(path):
+    """returns the bitmap of non empty tiles in the bundle at path
+    (without extension)
+    """
+    index = unbundle.BundleIndex.load(path)
+    bundle = unbundle.BundleFile(path + ".bundle")
+    bitmap = bytearray(BITMAP_SIZE)
+
+    try:
+        for bit, position in enumerate(index.offsets):
+            if bundle.extent(position)[1] > 0:
+                bitmap[bit >> 3] |= 1 << (bit & 7)
+    finally:
+        bundle.close()
+
+    return bitmap
+
+def scan_level(root, level):
+    """returns a dictionary of bundle name to bitmap for one level"""
+    directory = os.path.join(root, "L%02d" % level)
+    bundles = {}
+
+    for file_name in sorted(os.listdir(directory)):
+        match = bundle_pattern.match(file_name)
+        if not match:
+            continue
+
+        name = match.group(1)
+        path = os.path.join(directory, name)
+        if not os.path.exists(path + ".bundlx"):
+            continue
+
+        bundles[name] = scan_bundle(path)
+
+    return bundles
+
+def build(root="files/"):
+    """scans every level of the cache under root into a manifest"""
+    levels = {}
+    for directory in sorted(os.listdir(root)):
+        match = level_pattern.match(directory)
+        if match and os.path.isdir(os.path.join(root, directory)):
+            level = int(match.group(1))
+            levels[level] = scan_level(root, level)
+    return Manifest(levels)
+
+def load(path=MANIFEST_PATH):
+    """returns the manifest at path, or None if it hasn't been built"""
+    if not os.path.exists(path):
+        return None
+    return Manifest.load(path)
+
+def main(args):
+    root = args[1] if len(args) > 1 else "files/"
+    path = args[2] if len(args) > 2 else os.path.join(root, "manifest.json")
+
+    manifest = build(root)
+    manifest.save(path)
+
+    for level, bundles in sorted(manifest.levels.items()):
+        tiles = sum(bin(byte).count('1') for bitmap in bundles.values()
+                                          for byte in bitmap)
+        print("L%02d: %d bundles, %d tiles" % (level, len(bundles), tiles))
+    print("wrote {}".format(path))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,237 @@
+import os, sys, time, sqlite3, hashlib, argparse, threading
+from multiprocessing import Pool
+
+import unbundle, manifest
+
+BATCH_SIZE = 10000
+
+# the deduplicated mbtiles layout, identical images are stored once keyed
+# by their sha1. tile_row is the row of the cache, counted down from the
+# tileInfo origin, not the flipped tms row since the grid isn't web mercator
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+CREATE TABLE IF NOT EXISTS map (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_id TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index
+    ON map (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level,
+           map.tile_column AS tile_column,
+           map.tile_row AS tile_row,
+           images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+def in_extent(extent, row, col):
+    if extent is None:
+        return True
+    min_row, min_col, max_row, max_col = extent
+    return min_row <= row <= max_row and min_col <= col <= max_col
+
+def bundle_in_extent(extent, name):
+    if extent is None:
+        return True
+    row, col = unbundle.bundle_origin(name)
+    last = unbundle.TILES_PER_SIDE - 1
+    min_row, min_col, max_row, max_col = extent
+    return (row <= max_row and row + last >= min_row and
+            col <= max_col and col + last >= min_col)
+
+def export_bundle(task):
+    """reads every non empty tile of one bundle. returns the level, a
+    list of (row, column, tile id) and a dictionary of tile id to image,
+    so identical images only cross the process boundary once
+    """
+    root, level, name, extent = task
+    path = os.path.join(root, "L%02d" % level, name)
+    first_row, first_col = unbundle.bundle_origin(name)
+
+    index = unbundle.BundleIndex.load(path)
+    bundle = unbundle.BundleFile(path + ".bundle")
+
+    tiles = []
+    images = {}
+    try:
+        for slot, position in enumerate(index.offsets):
+            col = first_col + slot // unbundle.TILES_PER_SIDE
+            row = first_row + slot % unbundle.TILES_PER_SIDE
+            if not in_extent(extent, row, col):
+                continue
+
+            image = bundle.read(position)
+            if not image:
+                continue
+
+            tile_id = hashlib.sha1(image).hexdigest()
+            if tile_id not in images:
+                images[tile_id] = bytes(image)
+            tiles.append((row, col, tile_id))
+    finally:
+        bundle.close()
+
+    return level, tiles, images
+
+def find_bundles(root, levels=None, extent=None):
+    """returns the (level, bundle name) of every bundle to export"""
+    bundles = []
+    for directory in sorted(os.listdir(root)):
+        match = manifest.level_pattern.match(directory)
+        if not match:
+            continue
+
+        level = int(match.group(1))
+        if levels is not None and level not in levels:
+            continue
+
+        for file_name in sorted(os.listdir(os.path.join(root, directory))):
+            match = manifest.bundle_pattern.match(file_name)
+            if match and bundle_in_extent(extent, match.group(1)):
+                bundles.append((level, match.group(1)))
+
+    return bundles
+
+def export(root, path, levels=None, extent=None, workers=None):
+    """writes the bundles under root into the sqlite file at path,
+    reading one bundle per task across a process pool
+    """
+    bundles = find_bundles(root, levels, extent)
+    tasks = [(root, level, name, extent) for level, name in bundles]
+
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.execute("PRAGMA synchronous=OFF")
+
+    start = time.time()
+    pending = 0
+    count = 0
+    done = 0
+    zooms = set()
+
+    pool = Pool(workers)
+    try:
+        for level, tiles, images in pool.imap_unordered(export_bundle, tasks):
+            connection.executemany(
+                "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                ((tile_id, sqlite3.Binary(image))
+                 for tile_id, image in images.items()))
+            connection.executemany(
+                "INSERT OR REPLACE INTO map "
+                "(zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                ((level, col, row, tile_id) for row, col, tile_id in tiles))
+
+            if tiles:
+                zooms.add(level)
+            count += len(tiles)
+            pending += len(tiles)
+            done += 1
+
+            if pending >= BATCH_SIZE:
+                connection.commit()
+                pending = 0
+                print("{}/{} bundles, {} tiles, {:.1f}s"
+                      .format(done, len(tasks), count, time.time() - start))
+    finally:
+        pool.close()
+        pool.join()
+
+    metadata = {'name': os.path.basename(os.path.normpath(root)),
+                'format': 'png',
+                'type': 'baselayer'}
+    if zooms:
+        metadata['minzoom'] = str(min(zooms))
+        metadata['maxzoom'] = str(max(zooms))
+    connection.executemany(
+        "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+        metadata.items())
+    connection.commit()
+
+    unique = connection.execute("SELECT count(*) FROM images").fetchone()[0]
+    connection.close()
+
+    print("wrote {} tiles ({} unique images) from {} bundles to {} in {:.1f}s"
+          .format(count, unique, len(tasks), path, time.time() - start))
+
+class MBTilesReader(object):
+    """reads tiles from an exported sqlite file, with a read only
+    connection per thread
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError("Invalid path, tile file does not exist: {}"
+                          .format(path))
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.path),
+                                         uri=True)
+            self.local.connection = connection
+        return connection
+
+    def get_tile(self, level, row, column):
+        """returns the image, or None, given the level, row and column"""
+        result = self.connection.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (int(level), int(column), int(row))).fetchone()
+        return result[0] if result else None
+
+    def get_tiles(self, level, tiles):
+        """returns a dictionary of (row, column) to image, or None,
+        for each of the (row, column) pairs in tiles
+        """
+        return dict(((int(row), int(col)), self.get_tile(level, row, col))
+                    for row, col in tiles)
+
+    def get_tile_validator(self, level, row, column):
+        """returns the validator string (the content hash) and the
+        modification time of the file, or None if the tile isn't there
+        """
+        result = self.connection.execute(
+            "SELECT tile_id FROM map "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (int(level), int(column), int(row))).fetchone()
+        if not result:
+            return None
+        return result[0], self.mtime
+
+def parse_extent(value):
+    """parses "min_row,min_col,max_row,max_col" """
+    try:
+        extent = tuple(int(part) for part in value.split(','))
+    except ValueError:
+        extent = ()
+    if len(extent) != 4:
+        raise argparse.ArgumentTypeError(
+            "extent must be min_row,min_col,max_row,max_col")
+    return extent
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="export a compact cache to an mbtiles style sqlite file")
+    parser.add_argument('root', help="the cache directory, holding the Lxx folders")
+    parser.add_argument('output', help="the sqlite file to write")
+    parser.add_argument('--level', type=int, action='append', dest='levels',
+                        help="only export this level, can be repeated")
+    parser.add_argument('--extent', type=parse_extent,
+                        help="only export tiles in min_row,min_col,max_row,max_col")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes, defaults to the cpu count")
+    options = parser.parse_args(args[1:])
+
+    export(options.root, options.output, options.levels, options.extent,
+           options.workers)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,206 @@
+import sys, time, threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# upper bounds in seconds, from a resident bundle read to a slow geocode
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# how often the profiler samples the stack of the profiled thread
+SAMPLE_INTERVAL = 0.001
+
+# name -> (type, help, OrderedDict of labels -> metric)
+_families = OrderedDict()
+_families_lock = threading.Lock()
+
+def _register(kind, name, help, labels, create):
+    key = tuple(sorted(labels.items()))
+    with _families_lock:
+        family = _families.get(name)
+        if family is None:
+            family = (kind, help, OrderedDict())
+            _families[name] = family
+        elif family[0] != kind:
+            raise Exception("{} is already a {}".format(name, family[0]))
+
+        metric = family[2].get(key)
+        if metric is None:
+            metric = create()
+            family[2][key] = metric
+        return metric
+
+class Histogram(object):
+    """counts observations into cumulative buckets, as prometheus does"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        """returns (suffix, extra labels, value) for each sample"""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', format_value(bound)),), cumulative))
+        cumulative += counts[-1]
+        samples.append(('_bucket', (('le', '+Inf'),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Callback(object):
+    """a gauge or counter whose value is read from function when the
+    metrics are rendered, for values something else already keeps
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self):
+        return [('', (), self.function())]
+
+class Timer(object):
+    """context manager observing the time spent in it"""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS, **labels):
+    """returns the histogram with name and labels, creating it"""
+    return _register('histogram', name, help, labels,
+                     lambda: Histogram(buckets))
+
+def counter(name, help, **labels):
+    """returns the counter with name and labels, creating it"""
+    return _register('counter', name, help, labels, Counter)
+
+def gauge_callback(name, help, function, **labels):
+    return _register('gauge', name, help, labels, lambda: Callback(function))
+
+def counter_callback(name, help, function, **labels):
+    return _register('counter', name, help, labels, lambda: Callback(function))
+
+def timed(histogram):
+    """decorator observing the time each call of the function takes"""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+    return decorator
+
+def format_value(value):
+    if value == int(value) and abs(value) < 1e15:
+        return "{:.1f}".format(value)
+    return repr(float(value))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                                           .replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+def render():
+    """returns every metric in the prometheus text format"""
+    with _families_lock:
+        families = [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in _families.items()]
+
+    lines = []
+    for name, kind, help, metrics in families:
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, metric in metrics:
+            for suffix, extra, value in metric.samples():
+                lines.append("{}{}{} {}".format(name, suffix,
+                                                format_labels(labels + extra),
+                                                format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+class Sampler(object):
+    """samples the stack of one thread every interval seconds while it
+    is running, counting how often each stack was seen. a sketch of
+    where the time goes, at the cost of one extra thread per profile
+    """
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(code.co_filename.rsplit('/', 1)[-1],
+                                        code.co_name))
+            frame = frame.f_back
+        if stack:
+            stack = ';'.join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, name='sampler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        """returns the stacks in the collapsed format flame graph tools
+        read, one "outer;inner count" per line, most frequent first
+        """
+        stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return ''.join("{} {}\n".format(stack, count) for stack, count in stacks)
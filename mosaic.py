@@ -0,0 +1,164 @@
+import math
+from io import BytesIO
+
+from PIL import Image
+
+import unbundle
+
+class TileGrid(object):
+    """the tiling scheme of the service, from the tileInfo of its
+    service description
+    """
+    def __init__(self, tile_info, extent=None):
+        self.origin_x = tile_info['origin']['x']
+        self.origin_y = tile_info['origin']['y']
+        self.tile_size = tile_info['rows']
+        self.resolutions = dict((lod['level'], lod['resolution'])
+                                for lod in tile_info['lods'])
+        # (xmin, ymin, xmax, ymax) of the cached data, like fullExtent
+        self.extent = extent
+
+    def clip(self, bbox):
+        """returns the part of bbox inside the extent, or None if they
+        don't overlap
+        """
+        if self.extent is None:
+            return bbox
+        xmin = max(bbox[0], self.extent[0])
+        ymin = max(bbox[1], self.extent[1])
+        xmax = min(bbox[2], self.extent[2])
+        ymax = min(bbox[3], self.extent[3])
+        if xmin >= xmax or ymin >= ymax:
+            return None
+        return xmin, ymin, xmax, ymax
+
+    def choose_level(self, resolution):
+        """returns the coarsest level that is at least as detailed as
+        resolution (map units per pixel), or the finest level there is
+        """
+        levels = sorted(self.resolutions, key=lambda level: self.resolutions[level])
+        for level in reversed(levels):
+            if self.resolutions[level] <= resolution:
+                return level
+        return levels[0]
+
+    def pixel_bounds(self, level, bbox):
+        """returns the bbox (xmin, ymin, xmax, ymax) in pixels of the
+        level as (left, top, right, bottom), rows count down from the
+        origin
+        """
+        resolution = self.resolutions[level]
+        xmin, ymin, xmax, ymax = bbox
+        return ((xmin - self.origin_x) / resolution,
+                (self.origin_y - ymax) / resolution,
+                (xmax - self.origin_x) / resolution,
+                (self.origin_y - ymin) / resolution)
+
+    def covering_tiles(self, level, bbox):
+        """returns the first and last row and column of the tiles of
+        the level that cover bbox
+        """
+        left, top, right, bottom = self.pixel_bounds(level, bbox)
+        size = self.tile_size
+        first_row = max(0, int(math.floor(top / size)))
+        first_col = max(0, int(math.floor(left / size)))
+        last_row = max(first_row, int(math.ceil(bottom / size)) - 1)
+        last_col = max(first_col, int(math.ceil(right / size)) - 1)
+        return first_row, first_col, last_row, last_col
+
+    def canvas_pixels(self, level, bbox):
+        """returns the number of pixels in the tiles of the level that
+        cover bbox
+        """
+        first_row, first_col, last_row, last_col = self.covering_tiles(level, bbox)
+        return ((last_row - first_row + 1) * (last_col - first_col + 1) *
+                self.tile_size * self.tile_size)
+
+    def fit_level(self, level, bbox, max_pixels):
+        """returns level, or the first coarser one whose tiles covering
+        bbox have at most max_pixels. raises ValueError if none does
+        """
+        levels = sorted((resolution, other)
+                        for other, resolution in self.resolutions.items()
+                        if resolution >= self.resolutions[level])
+        for resolution, other in levels:
+            if self.canvas_pixels(other, bbox) <= max_pixels:
+                return other
+        raise ValueError("Export of {} needs more than {} pixels".format(
+            bbox, max_pixels))
+
+def decode_tiles(read_tiles, level, tiles):
+    """reads and decodes the (row, col) tiles of one bundle, returns a
+    list of (row, col, PIL image)
+    """
+    images = read_tiles(level, tiles)
+    decoded = []
+    for row, col in tiles:
+        image = images.get((row, col))
+        if image:
+            decoded.append((row, col, Image.open(BytesIO(image)).convert('RGBA')))
+    return decoded
+
+def export(grid, bbox, width, height, read_tiles, executor, max_pixels=None):
+    """returns a PIL image of width by height covering bbox (xmin,
+    ymin, xmax, ymax in the units of the service), pasted together from
+    the tiles of the best level. read_tiles(level, [(row, col), ...])
+    returns a dictionary of (row, col) to image bytes. the tiles are
+    read and decoded on executor, one task per bundle, and every tile
+    is decoded exactly once. only the part of bbox inside the extent of
+    the grid is read, and a coarser level is used if the tiles would
+    take more than max_pixels
+    """
+    result = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    clipped = grid.clip(bbox)
+    if clipped is None:
+        return result
+
+    xmin, ymin, xmax, ymax = bbox
+    resolution = max((xmax - xmin) / float(width), (ymax - ymin) / float(height))
+    level = grid.choose_level(resolution)
+    if max_pixels is not None:
+        level = grid.fit_level(level, clipped, max_pixels)
+
+    first_row, first_col, last_row, last_col = grid.covering_tiles(level, clipped)
+    size = grid.tile_size
+
+    bundles = {}
+    for row in range(first_row, last_row + 1):
+        for col in range(first_col, last_col + 1):
+            name = unbundle.bundle_name(row, col)
+            bundles.setdefault(name, []).append((row, col))
+
+    futures = [executor.submit(decode_tiles, read_tiles, level, tiles)
+               for tiles in bundles.values()]
+
+    canvas = Image.new('RGBA', ((last_col - first_col + 1) * size,
+                                (last_row - first_row + 1) * size),
+                       (0, 0, 0, 0))
+    for future in futures:
+        for row, col, image in future.result():
+            canvas.paste(image, ((col - first_col) * size,
+                                 (row - first_row) * size))
+
+    left, top, right, bottom = grid.pixel_bounds(level, clipped)
+    left -= first_col * size
+    right -= first_col * size
+    top -= first_row * size
+    bottom -= first_row * size
+
+    left, top, right, bottom = [int(round(value))
+                                for value in (left, top, right, bottom)]
+    box = (left, top, max(right, left + 1), max(bottom, top + 1))
+
+    # where the clipped part of bbox goes in the image
+    scale_x = width / (xmax - xmin)
+    scale_y = height / (ymax - ymin)
+    target_left = int(round((clipped[0] - xmin) * scale_x))
+    target_top = int(round((ymax - clipped[3]) * scale_y))
+    target_right = max(target_left + 1, int(round((clipped[2] - xmin) * scale_x)))
+    target_bottom = max(target_top + 1, int(round((ymax - clipped[1]) * scale_y)))
+
+    image = canvas.crop(box).resize((target_right - target_left,
+                                     target_bottom - target_top), Image.BILINEAR)
+    result.paste(image, (target_left, target_top))
+    return result
@@ -0,0 +1,185 @@
+import os, sys, time, argparse
+from io import BytesIO
+from multiprocessing import Pool
+
+from PIL import Image
+
+import unbundle, manifest
+
+TILE_SIZE = 256
+
+def level_directory(root, level):
+    return os.path.join(root, "L%02d" % level)
+
+def find_levels(root):
+    """returns the levels that have a directory under root"""
+    levels = []
+    for directory in os.listdir(root):
+        match = manifest.level_pattern.match(directory)
+        if match and os.path.isdir(os.path.join(root, directory)):
+            levels.append(int(match.group(1)))
+    return sorted(levels)
+
+def parent_bundles(root, level):
+    """returns the names of the bundles at level that have at least
+    one child bundle at level + 1
+    """
+    names = set()
+    for file_name in os.listdir(level_directory(root, level + 1)):
+        match = manifest.bundle_pattern.match(file_name)
+        if match:
+            row, col = unbundle.bundle_origin(match.group(1))
+            names.add(unbundle.bundle_name(row // 2, col // 2))
+    return sorted(names)
+
+def open_children(root, level, name):
+    """returns a dictionary of bundle name to (index, mapped bundle
+    file) for the child bundles at level + 1 under the parent bundle
+    with the given name that exist
+    """
+    first_row, first_col = unbundle.bundle_origin(name)
+    children = {}
+
+    # a parent bundle covers 2 x 2 child bundles
+    for row_step in (0, unbundle.TILES_PER_SIDE):
+        for col_step in (0, unbundle.TILES_PER_SIDE):
+            child_name = unbundle.bundle_name(first_row * 2 + row_step,
+                                              first_col * 2 + col_step)
+            path = os.path.join(level_directory(root, level + 1), child_name)
+            if not os.path.exists(path + ".bundlx"):
+                continue
+            children[child_name] = (unbundle.BundleIndex.load(path),
+                                    unbundle.BundleFile(path + ".bundle"))
+
+    return children
+
+def read_children(children, row, col):
+    """returns a list of (row offset, column offset, image) for the up
+    to four child tiles of the parent tile at row and column, read from
+    the open child bundles
+    """
+    images = []
+    for row_offset in (0, 1):
+        for col_offset in (0, 1):
+            child_row = row * 2 + row_offset
+            child_col = col * 2 + col_offset
+            child = children.get(unbundle.bundle_name(child_row, child_col))
+            if child is None:
+                continue
+            index, bundle = child
+            image = bundle.read(index.position(child_row, child_col))
+            if image:
+                images.append((row_offset, col_offset, bytes(image)))
+    return images
+
+def downsample(children, image_format='PNG'):
+    """returns a tile made from up to four child tiles, given a list
+    of (row offset, column offset, image)
+    """
+    canvas = Image.new('RGBA', (TILE_SIZE * 2, TILE_SIZE * 2), (0, 0, 0, 0))
+    for row, col, image in children:
+        child = Image.open(BytesIO(image)).convert('RGBA')
+        canvas.paste(child, (col * TILE_SIZE, row * TILE_SIZE))
+
+    tile = canvas.resize((TILE_SIZE, TILE_SIZE), Image.LANCZOS)
+    content = BytesIO()
+    tile.save(content, image_format)
+    return content.getvalue()
+
+def build_bundle(task):
+    """writes one parent bundle at level from its children at level + 1,
+    returns 1 if it was written, 0 if its children were all empty
+    """
+    root, level, name = task
+    children = open_children(root, level, name)
+
+    # a column of parent tiles at a time, each from its children read
+    # straight out of the maps, so only four child tiles are in memory
+    # and the parent is streamed to disk
+    first_row, first_col = unbundle.bundle_origin(name)
+    writer = None
+    try:
+        for col in range(first_col, first_col + unbundle.TILES_PER_SIDE):
+            for row in range(first_row, first_row + unbundle.TILES_PER_SIDE):
+                images = read_children(children, row, col)
+                if not images:
+                    continue
+                if writer is None:
+                    writer = unbundle.BundleWriter(
+                        os.path.join(level_directory(root, level), name))
+                writer.add(row, col, downsample(images))
+    finally:
+        for index, bundle in children.values():
+            bundle.close()
+
+    if writer is None:
+        return 0
+    writer.close()
+    return 1
+
+def build_level(root, level, pool):
+    """writes every bundle of level from the tiles at level + 1"""
+    directory = level_directory(root, level)
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+    tasks = [(root, level, name) for name in parent_bundles(root, level)]
+    written = sum(pool.imap_unordered(build_bundle, tasks))
+    return written
+
+def build(root="files/", min_level=0, max_level=None, workers=None,
+          force=False):
+    """fills in the missing levels of the cache under root, from the
+    finest level that exists down to min_level. each level is built
+    from the one below it, so only one level is in flight at a time
+    """
+    levels = find_levels(root)
+    if not levels:
+        raise Exception("No levels found under {}".format(root))
+
+    if max_level is None:
+        max_level = max(levels) - 1
+
+    pool = Pool(workers)
+    try:
+        for level in range(max_level, min_level - 1, -1):
+            if level in levels and not force:
+                print("L%02d exists, skipping" % level)
+                continue
+            if not os.path.isdir(level_directory(root, level + 1)):
+                print("L%02d has no L%02d to build from, skipping"
+                      % (level, level + 1))
+                continue
+
+            start = time.time()
+            written = build_level(root, level, pool)
+            print("L%02d: %d bundles in %.1fs" % (level, written,
+                                                  time.time() - start))
+    finally:
+        pool.close()
+        pool.join()
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="build missing coarser levels of a compact cache "
+                    "by downsampling the level below")
+    parser.add_argument('root', nargs='?', default="files/",
+                        help="the cache directory, holding the Lxx folders")
+    parser.add_argument('--min-level', type=int, default=0,
+                        help="the coarsest level to build")
+    parser.add_argument('--max-level', type=int, default=None,
+                        help="the finest level to build, defaults to one "
+                             "above the finest level that exists")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes, defaults to the cpu count")
+    parser.add_argument('--force', action='store_true',
+                        help="rebuild levels that already exist. a server "
+                             "already serving them needs a restart, or "
+                             "WATCH_TILES, to pick the new bundles up")
+    options = parser.parse_args(args[1:])
+
+    build(options.root, options.min_level, options.max_level,
+          options.workers, options.force)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,7 +1,14 @@
 import os
 import sys
+import json
+import threading
 import math
+import time
+import struct
 import hashlib
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 
@@ -13,6 +20,70 @@ ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', 'localhost').split(',')
 
 BASE_DIR = os.path.dirname(__file__)
 
+TILE_CACHE_BYTES = int(os.environ.get('TILE_CACHE_BYTES', 64 * 1024 * 1024))
+
+MAX_BATCH_TILES = int(os.environ.get('MAX_BATCH_TILES', 256))
+
+TILE_SENDFILE = os.environ.get('TILE_SENDFILE', 'off') == 'on'
+
+SENDFILE_MIN_LEVEL = int(os.environ.get('SENDFILE_MIN_LEVEL', 6))
+
+# serve tiles from an exported mbtiles file instead of the bundles
+TILE_MBTILES = os.environ.get('TILE_MBTILES')
+
+TILE_MANIFEST = os.environ.get('TILE_MANIFEST', 'files/manifest.json')
+
+# synthesize empty tiles from the nearest ancestor tile that exists
+OVERZOOM = os.environ.get('OVERZOOM', 'on') == 'on'
+
+# what tiles the manifest says don't exist are answered with, blank or 404
+MISSING_TILE = os.environ.get('MISSING_TILE', 'blank')
+
+TRANSCODE_CACHE_BYTES = int(os.environ.get('TRANSCODE_CACHE_BYTES', 32 * 1024 * 1024))
+
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', 4))
+
+# levels to transcode into TRANSCODE_WARM_FORMATS at startup, e.g. 0-5
+TRANSCODE_WARM_LEVELS = os.environ.get('TRANSCODE_WARM_LEVELS', '')
+
+TRANSCODE_WARM_FORMATS = os.environ.get('TRANSCODE_WARM_FORMATS', 'webp')
+
+# how long concurrent requests for a tile wait for the one shared read
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 30))
+
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 8))
+
+# tiles pasted for an export, as a multiple of the largest image
+# served, before a coarser level is used instead
+EXPORT_CANVAS_FACTOR = float(os.environ.get('EXPORT_CANVAS_FACTOR', 4))
+
+# lets a request with ?profile=1 return a sampled profile of itself
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', 'off') == 'on'
+
+# limits on reverse geocoding, in feet and addresses per request
+MAX_REVERSE_DISTANCE = float(os.environ.get('MAX_REVERSE_DISTANCE', 5280))
+
+MAX_LOCATIONS = int(os.environ.get('MAX_LOCATIONS', 50))
+
+MAX_BATCH_ADDRESSES = int(os.environ.get('MAX_BATCH_ADDRESSES', 1000))
+
+# addresses of a geocodeAddresses request reprojected together
+GEOCODE_CHUNK_SIZE = 100
+
+# load the address data and the parser when the server starts
+GEOCODE_PRELOAD = os.environ.get('GEOCODE_PRELOAD', 'on') == 'on'
+
+# seconds between polls of the bundles for changes, 0 turns it off
+WATCH_TILES = float(os.environ.get('WATCH_TILES', 0))
+
+# how long clients and proxies may reuse a tile, as (up to level, seconds),
+# the coarse levels are the least likely to change
+TILE_MAX_AGE = (
+  (5, 7 * 24 * 60 * 60),
+  (9, 24 * 60 * 60),
+  (100, 60 * 60),
+)
+
 settings.configure(
   DEBUG=DEBUG,
   SECRET_KEY=SECRET_KEY,
@@ -22,7 +93,7 @@ settings.configure(
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-  ),
+  ) + (('{}.ProfileMiddleware'.format(__name__),) if PROFILE_REQUESTS else ()),
   INSTALLED_APPS=(
     'django.contrib.staticfiles',
   ),
@@ -39,27 +110,225 @@ from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 from django import forms
 from django.conf.urls import url
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.wsgi import get_wsgi_application
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotFound, StreamingHttpResponse,
+                         FileResponse)
 from django.shortcuts import render
-from django.views.decorators.http import etag
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+
+import unbundle, locator, tilecache, manifest, mbtiles, transcode, mosaic
+import coalesce, watcher, metrics
+
+logger = logging.getLogger(__name__)
+
+tile_cache = tilecache.TileCache(TILE_CACHE_BYTES)
+
+tile_flight = coalesce.SingleFlight(COALESCE_TIMEOUT)
+
+tile_manifest = manifest.load(TILE_MANIFEST)
+
+tile_reader = mbtiles.MBTilesReader(TILE_MBTILES) if TILE_MBTILES else None
+
+transcoder = transcode.Transcoder(TRANSCODE_CACHE_BYTES, TRANSCODE_WORKERS)
+
+TILE_FORMATS = transcode.supported_formats()
+
+def register_cache_metrics(name, cache):
+    """exposes the counters the cache keeps itself"""
+    def stat(key):
+        return lambda: cache.stats()[key]
+
+    metrics.counter_callback('tile_cache_requests_total',
+                             "lookups in the tile caches",
+                             stat('hits'), cache=name, result='hit')
+    metrics.counter_callback('tile_cache_requests_total',
+                             "lookups in the tile caches",
+                             stat('misses'), cache=name, result='miss')
+    metrics.counter_callback('tile_cache_evictions_total',
+                             "entries evicted from the tile caches",
+                             stat('evictions'), cache=name)
+    metrics.gauge_callback('tile_cache_bytes', "size of the tile caches",
+                           stat('bytes'), cache=name)
+
+register_cache_metrics('tile', tile_cache)
+
+register_cache_metrics('transcode', transcoder.cache)
+
+def read_tile(lod, y, x):
+    if tile_reader is not None:
+        return tile_reader.get_tile(lod, y, x)
+    return unbundle.get_map_tile(lod, y, x)
+
+def read_tiles(lod, tiles):
+    if tile_reader is not None:
+        return tile_reader.get_tiles(lod, tiles)
+    return unbundle.get_map_tiles(lod, tiles)
+
+def read_tile_validator(lod, y, x):
+    if tile_reader is not None:
+        return tile_reader.get_tile_validator(lod, y, x)
+    return unbundle.get_tile_validator(lod, y, x)
+
+with open(os.path.join(BASE_DIR, 'templates', 'service_description.json')) as f:
+    SERVICE_DESCRIPTION = json.load(f)
+
+TILE_INFO = SERVICE_DESCRIPTION['tileInfo']
+
+TILE_SIZE = TILE_INFO['rows']
+
+RESOLUTIONS = dict((lod['level'], lod['resolution']) for lod in TILE_INFO['lods'])
+
+FULL_EXTENT = SERVICE_DESCRIPTION['fullExtent']
+
+tile_grid = mosaic.TileGrid(TILE_INFO, (FULL_EXTENT['xmin'], FULL_EXTENT['ymin'],
+                                        FULL_EXTENT['xmax'], FULL_EXTENT['ymax']))
 
-import unbundle, locator
+export_executor = ThreadPoolExecutor(EXPORT_WORKERS)
+
+# format name -> (pil format, content type)
+EXPORT_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'png8': ('PNG', 'image/png'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+def render_blank_tile(image_format='PNG'):
+    image = Image.new('RGBA', (256, 256), (0, 0, 0, 0))
+    content = BytesIO()
+    image.save(content, image_format)
+    return content.getvalue()
+
+BLANK_TILE = render_blank_tile()
+
+BLANK_TILE_ETAG = hashlib.sha1(BLANK_TILE).hexdigest()
+
+def tile_exists(lod, y, x):
+    """returns False if the manifest says the tile is empty or outside
+    of the cache, True if it exists or there is no manifest to ask
+    """
+    return tile_manifest is None or tile_manifest.has_tile(lod, y, x)
+
+class BundleRange(object):
+    """file like object over length bytes of a bundle file, starting
+    at offset. the file is positioned at offset, so a wsgi server that
+    sends wsgi.file_wrapper objects with sendfile can send the range
+    straight from fileno() (bounded by the Content-Length header),
+    anything else falls back to read()
+    """
+    def __init__(self, path, offset, length):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
 
 class TileImageForm(forms.Form):
     lod = forms.IntegerField(min_value=0, max_value=100)
     y = forms.IntegerField(min_value=0, max_value=10000000)
     x = forms.IntegerField(min_value=0, max_value=10000000)
 
+    def generate_range(self):
+        """returns the bundle path, offset and length of the tile,
+        or None if it isn't in a bundle
+        """
+        lod = self.cleaned_data['lod']
+        y = self.cleaned_data['y']
+        x = self.cleaned_data['x']
+
+        return unbundle.get_map_tile_range(lod, y, x)
+
     def generate(self, image_format='PNG'):
         lod = self.cleaned_data['lod']
         y = self.cleaned_data['y']
         x = self.cleaned_data['x']
 
-        image = unbundle.get_map_tile(lod, y, x)
-        return image
+        key = (lod, y, x)
+        image = tile_cache.get(key)
+        if image is not None:
+            return image
+
+        # concurrent misses for the same tile share one read
+        return tile_flight.do(key, load_tile, lod, y, x, image_format)
+
+class TileBatchForm(forms.Form):
+    lod = forms.IntegerField(min_value=0, max_value=100)
+    tiles = forms.CharField()
+
+    def clean_tiles(self):
+        """parses "y,x;y,x;..." into a list of (y, x) tuples"""
+        tiles = []
+        for pair in self.cleaned_data['tiles'].split(';'):
+            try:
+                y, x = [int(value) for value in pair.split(',')]
+            except ValueError:
+                raise forms.ValidationError('Invalid tile: {}'.format(pair))
+            if not (0 <= y <= 10000000 and 0 <= x <= 10000000):
+                raise forms.ValidationError('Invalid tile: {}'.format(pair))
+            tiles.append((y, x))
+
+        if len(tiles) > MAX_BATCH_TILES:
+            raise forms.ValidationError('Too many tiles, at most {}'
+                                        .format(MAX_BATCH_TILES))
+        return tiles
+
+    def generate(self, image_format='PNG'):
+        """returns a list of (y, x, image) in the requested order"""
+        lod = self.cleaned_data['lod']
+        tiles = self.cleaned_data['tiles']
+
+        images = {}
+        missing = []
+        for y, x in tiles:
+            image = tile_cache.get((lod, y, x))
+            if image is None:
+                missing.append((y, x))
+            else:
+                images[(y, x)] = image
+
+        if tile_manifest is not None:
+            for y, x in missing:
+                if not tile_manifest.has_tile(lod, y, x):
+                    image = None
+                    if OVERZOOM:
+                        image = overzoom_tile(lod, y, x, image_format)
+                    if image:
+                        tile_cache.put((lod, y, x), image)
+                    elif MISSING_TILE == 'blank':
+                        image = BLANK_TILE
+                    else:
+                        image = b''
+                    images[(y, x)] = image
+            missing = [key for key in missing if key not in images]
+
+        if missing:
+            found = read_tiles(lod, missing)
+            for y, x in missing:
+                image = found[(y, x)]
+                if not image and OVERZOOM:
+                    image = overzoom_tile(lod, y, x, image_format)
+                if not image:
+                    image = placeholder_tile(lod, y, x, image_format)
+                image = bytes(image)
+                tile_cache.put((lod, y, x), image)
+                images[(y, x)] = image
+
+        return [(y, x, images[(y, x)]) for y, x in tiles]
 
 class TileForm(forms.Form):
 
@@ -72,11 +341,6 @@ class TileForm(forms.Form):
         y = self.cleaned_data['y']
         x = self.cleaned_data['x']
 
-        key = '{}.{}.{}'.format(lod, y, x)
-        content = cache.get(key)
-        if content:
-            return content
-
         height = 256
         width = 256
 
@@ -107,15 +371,491 @@ class TileForm(forms.Form):
 
         content = BytesIO()
         image.save(content, image_format)
-        content.seek(0)
 
-        cache.set(key, content, 60 * 60)
+        return content.getvalue()
 
-        return content
+class ExportForm(forms.Form):
+    bbox = forms.CharField()
+    size = forms.CharField(required=False)
+    format = forms.ChoiceField(choices=[(name, name) for name in EXPORT_FORMATS],
+                               required=False)
 
-def generate_tile_etag(request, lod, y, x):
+    def clean_bbox(self):
+        """parses "xmin,ymin,xmax,ymax" in the spatial reference of
+        the service
+        """
+        try:
+            bbox = [float(value) for value in self.cleaned_data['bbox'].split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            raise forms.ValidationError('Invalid bbox, expected xmin,ymin,xmax,ymax')
+        return bbox
+
+    def clean_size(self):
+        """parses "width,height", 400 by 400 if not given"""
+        size = self.cleaned_data['size'] or '400,400'
+        try:
+            width, height = [int(value) for value in size.split(',')]
+        except ValueError:
+            raise forms.ValidationError('Invalid size, expected width,height')
+        if not (0 < width <= SERVICE_DESCRIPTION['maxImageWidth'] and
+                0 < height <= SERVICE_DESCRIPTION['maxImageHeight']):
+            raise forms.ValidationError('Invalid size, at most {},{}'.format(
+                SERVICE_DESCRIPTION['maxImageWidth'],
+                SERVICE_DESCRIPTION['maxImageHeight']))
+        return width, height
+
+    def generate(self):
+        """returns the encoded image and its content type"""
+        bbox = self.cleaned_data['bbox']
+        width, height = self.cleaned_data['size']
+        image_format = self.cleaned_data['format'] or 'png'
+
+        max_pixels = (EXPORT_CANVAS_FACTOR * SERVICE_DESCRIPTION['maxImageWidth'] *
+                      SERVICE_DESCRIPTION['maxImageHeight'])
+        image = mosaic.export(tile_grid, bbox, width, height, cached_tiles,
+                              export_executor, max_pixels)
+
+        if image_format == 'jpg':
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[3])
+            image = background
+        elif image_format == 'png8':
+            image = image.quantize(256, method=Image.FASTOCTREE)
+
+        pil_format, content_type = EXPORT_FORMATS[image_format]
+        content = BytesIO()
+        image.save(content, pil_format)
+        return content.getvalue(), content_type
+
+def parse_spatial_reference(value):
+    """returns the epsg code of a wkid, or of a json spatial reference
+    like {"wkid": 4326}, esri wkids are translated. raises ValueError
+    for one that can't be transformed to or from
+    """
+    if isinstance(value, str) and value.lstrip().startswith('{'):
+        value = json.loads(value)
+    if isinstance(value, dict):
+        value = value.get('latestWkid') or value['wkid']
+    epsg = int(value)
+    for code, esri_wkid in locator.ESRI_WKIDS.items():
+        if epsg == esri_wkid:
+            epsg = code
+
+    try:
+        locator.get_transformation(locator.EPSG_2277, epsg)
+    except Exception:
+        raise ValueError("Unsupported spatial reference: {}".format(value))
+    return epsg
+
+class GeocodeForm(forms.Form):
+    """the parameters every geocode operation takes"""
+    maxLocations = forms.IntegerField(min_value=1, max_value=MAX_LOCATIONS,
+                                      required=False)
+    outFields = forms.CharField(required=False)
+    outSR = forms.CharField(required=False)
+
+    def clean_outFields(self):
+        """parses "field,field" or "*" into a tuple of field names"""
+        out_fields = self.cleaned_data['outFields'].strip()
+        if not out_fields:
+            return ()
+        if out_fields == '*':
+            return locator.OUT_FIELDS
+
+        fields = tuple(field.strip() for field in out_fields.split(','))
+        for field in fields:
+            if field not in locator.OUT_FIELDS:
+                raise forms.ValidationError('Invalid outFields, {} is not one of {}'
+                                            .format(field, ','.join(locator.OUT_FIELDS)))
+        return fields
+
+    def clean_outSR(self):
+        out_sr = self.cleaned_data['outSR']
+        if not out_sr:
+            return locator.EPSG_2277
+        try:
+            return parse_spatial_reference(out_sr)
+        except (ValueError, KeyError, TypeError):
+            raise forms.ValidationError('Invalid outSR, expected a wkid')
+
+def stream_json(head, items, tail):
+    """yields a json document a piece at a time, head and tail are its
+    text around a list of items
+    """
+    yield head
+    for index, item in enumerate(items):
+        yield (',' if index else '') + json.dumps(item)
+    yield tail
+
+class FindCandidatesForm(GeocodeForm):
+    SingleLine = forms.CharField(required=False)
+    Address = forms.CharField(required=False)
+
+    def clean(self):
+        cleaned_data = super(FindCandidatesForm, self).clean()
+        if not (cleaned_data.get('SingleLine') or cleaned_data.get('Address')):
+            raise forms.ValidationError('SingleLine is required')
+        return cleaned_data
+
+    def generate(self):
+        """yields the json of the candidates"""
+        epsg = self.cleaned_data['outSR']
+        address = self.cleaned_data['SingleLine'] or self.cleaned_data['Address']
+
+        # an address that can't be parsed just has no candidates, any
+        # other failure is an error
+        try:
+            candidates = locator.coalesced_candidates(
+                address, epsg, self.cleaned_data['outFields'],
+                self.cleaned_data['maxLocations'] or MAX_LOCATIONS)
+        except locator.AddressError:
+            candidates = []
+
+        head = '{{"spatialReference":{},"candidates":['.format(
+            json.dumps(locator.spatial_reference(epsg)))
+        return stream_json(head, candidates, ']}')
+
+def unmatched_location(status):
+    """returns the location of an address with no match, status U, or
+    one that failed, status E
+    """
+    return {'address': '', 'location': None, 'score': 0,
+            'attributes': {'Status': status}}
+
+class GeocodeAddressesForm(GeocodeForm):
+    addresses = forms.CharField()
+
+    def clean_addresses(self):
+        """parses {"records": [{"attributes": {"OBJECTID": 1,
+        "SingleLine": "..."}}, ...]} into a list of (id, address)
+        """
+        try:
+            records = json.loads(self.cleaned_data['addresses'])['records']
+            addresses = []
+            for record in records:
+                attributes = record['attributes']
+                address = (attributes.get('SingleLine') or
+                           attributes.get('Address') or '')
+                if not isinstance(address, str):
+                    raise TypeError(address)
+                addresses.append((attributes.get('OBJECTID'), address))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise forms.ValidationError('Invalid addresses, expected records')
+
+        if len(addresses) > MAX_BATCH_ADDRESSES:
+            raise forms.ValidationError('Too many addresses, at most {}'
+                                        .format(MAX_BATCH_ADDRESSES))
+        return addresses
+
+    def locations(self, epsg):
+        """yields the best match for each address, reprojected a chunk
+        of addresses at a time. the response has already started when
+        these are made, so a record that fails gets the status E
+        rather than cutting the json short
+        """
+        out_fields = self.cleaned_data['outFields']
+        addresses = self.cleaned_data['addresses']
+
+        for start in range(0, len(addresses), GEOCODE_CHUNK_SIZE):
+            chunk = []
+            for result_id, address in addresses[start:start + GEOCODE_CHUNK_SIZE]:
+                status = 'U'
+                try:
+                    candidates = locator.coalesced_candidates(
+                        address, locator.EPSG_2277, out_fields, 1)
+                except locator.AddressError:
+                    candidates = []
+                except Exception:
+                    logger.exception("Could not geocode %r", address)
+                    candidates = []
+                    status = 'E'
+
+                if candidates:
+                    location = candidates[0]
+                    location['attributes']['Status'] = 'M'
+                else:
+                    location = unmatched_location(status)
+                location['attributes']['ResultID'] = result_id
+                chunk.append(location)
+
+            matched = [location for location in chunk if location['location']]
+            try:
+                locator.reproject(matched, epsg)
+            except Exception:
+                logger.exception("Could not reproject to %s", epsg)
+                for location in matched:
+                    result_id = location['attributes']['ResultID']
+                    location.clear()
+                    location.update(unmatched_location('E'))
+                    location['attributes']['ResultID'] = result_id
+            for location in chunk:
+                yield location
+
+    def generate(self):
+        """yields the json of the locations, in the order of the records"""
+        epsg = self.cleaned_data['outSR']
+        locator.get_address_index()
+
+        head = '{{"spatialReference":{},"locations":['.format(
+            json.dumps(locator.spatial_reference(epsg)))
+        return stream_json(head, self.locations(epsg), ']}')
+
+class ReverseGeocodeForm(GeocodeForm):
+    location = forms.CharField()
+    distance = forms.FloatField(min_value=0, max_value=MAX_REVERSE_DISTANCE,
+                                required=False)
+
+    def clean_location(self):
+        """parses "x,y" in the spatial reference of the locator, or
+        {"x": x, "y": y, "spatialReference": {"wkid": wkid}}, returns
+        x, y and the epsg code
+        """
+        location = self.cleaned_data['location']
+        try:
+            if location.lstrip().startswith('{'):
+                point = json.loads(location)
+                epsg = locator.EPSG_2277
+                if point.get('spatialReference'):
+                    epsg = parse_spatial_reference(point['spatialReference'])
+                x, y = float(point['x']), float(point['y'])
+            else:
+                x, y = [float(value) for value in location.split(',')]
+                epsg = locator.EPSG_2277
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise forms.ValidationError('Invalid location, expected x,y')
+
+        # float takes nan and inf, which no point is near
+        if not (math.isfinite(x) and math.isfinite(y)):
+            raise forms.ValidationError('Invalid location, expected x,y')
+        return x, y, epsg
+
+    def clean_distance(self):
+        distance = self.cleaned_data['distance']
+        if distance is not None and not math.isfinite(distance):
+            raise forms.ValidationError('Invalid distance')
+        return distance
+
+    def generate(self):
+        x, y, location_epsg = self.cleaned_data['location']
+        distance = self.cleaned_data['distance']
+        if distance is None:
+            distance = locator.REVERSE_DISTANCE
+        return locator.reverse_geocode(x, y,
+                                       self.cleaned_data['maxLocations'] or 1,
+                                       distance, self.cleaned_data['outSR'],
+                                       location_epsg)
+
+def cached_tiles(lod, tiles):
+    """returns a dictionary of (y, x) to image for the (y, x) tiles,
+    from the tile cache where possible
+    """
+    images = {}
+    missing = []
+    for y, x in tiles:
+        image = tile_cache.get((lod, y, x))
+        if image is None:
+            if tile_exists(lod, y, x):
+                missing.append((y, x))
+        else:
+            images[(y, x)] = image
+
+    if missing:
+        images.update(read_tiles(lod, missing))
+    return images
+
+def load_tile(lod, y, x, image_format='PNG'):
+    """reads the tile, or makes one up when it is empty, and puts it
+    in the tile cache
+    """
+    image = None
+    if tile_exists(lod, y, x):
+        image = read_tile(lod, y, x)
+    if not image and OVERZOOM:
+        with OVERZOOM_SECONDS.time():
+            image = overzoom_tile(lod, y, x, image_format)
+    if not image:
+        image = placeholder_tile(lod, y, x, image_format)
+
+    image = bytes(image)
+    tile_cache.put((lod, y, x), image)
+    return image
+
+PLACEHOLDER_SECONDS = metrics.histogram(
+    'tile_stage_seconds', "time spent in each stage of serving a tile",
+    stage='placeholder')
+
+OVERZOOM_SECONDS = metrics.histogram(
+    'tile_stage_seconds', "time spent in each stage of serving a tile",
+    stage='overzoom')
+
+def placeholder_tile(lod, y, x, image_format='PNG'):
+    form = TileForm({'lod': lod,'y': y, 'x': x})
+    if form.is_valid():
+        with PLACEHOLDER_SECONDS.time():
+            return form.generate(image_format)
+
+def choose_format(image_format, accept):
+    """returns image_format, or the best format the accept header
+    allows if it is empty. returns None for unknown formats
+    """
+    if image_format:
+        image_format = image_format.lower()
+        return image_format if image_format in TILE_FORMATS else None
+
+    if 'webp' in TILE_FORMATS and 'image/webp' in accept:
+        return 'webp'
+    return transcode.DEFAULT_FORMAT
+
+def negotiate_format(request):
+    """returns the tile format asked for with ?format=, or the best
+    one the Accept header allows. returns None for unknown formats
+    """
+    return choose_format(request.GET.get('format'),
+                         request.META.get('HTTP_ACCEPT', ''))
+
+def ancestors(lod, y, x):
+    """yields the level, y, x and scale of the tiles covering this
+    one at each coarser level of the service, nearest first
+    """
+    resolution = RESOLUTIONS.get(lod)
+    if resolution is None:
+        return
+
+    for level in sorted(RESOLUTIONS, reverse=True):
+        if level >= lod:
+            continue
+        scale = int(round(RESOLUTIONS[level] / resolution))
+        if scale > TILE_SIZE:
+            return
+        yield level, y // scale, x // scale, scale
+
+def overzoom_source(lod, y, x):
+    """returns the level, y, x and scale of the nearest ancestor that
+    the manifest says exists, or None
+    """
+    if tile_manifest is None:
+        return None
+
+    for source in ancestors(int(lod), int(y), int(x)):
+        if tile_manifest.has_tile(*source[:3]):
+            return source
+    return None
+
+def overzoom_tile(lod, y, x, image_format='PNG'):
+    """returns the tile cropped and resampled from the matching part
+    of the nearest ancestor tile that exists, or None
+    """
+    for level, parent_y, parent_x, scale in ancestors(lod, y, x):
+        if not tile_exists(level, parent_y, parent_x):
+            continue
+
+        parent = tile_cache.get((level, parent_y, parent_x))
+        if parent is None:
+            parent = read_tile(level, parent_y, parent_x)
+        if not parent:
+            continue
+
+        size = TILE_SIZE // scale
+        left = (x % scale) * size
+        top = (y % scale) * size
+
+        image = Image.open(BytesIO(parent))
+        image = image.crop((left, top, left + size, top + size))
+        image = image.resize((TILE_SIZE, TILE_SIZE), Image.BILINEAR)
+
+        content = BytesIO()
+        image.save(content, image_format)
+        return content.getvalue()
+
+    return None
+
+def tile_has_image(lod, y, x):
+    """returns whether a tile that tile_exists holds an image, without
+    reading the bundle
+    """
+    if tile_reader is not None:
+        # the reader has no validator for tiles it doesn't hold
+        return True
+    if tile_manifest is not None:
+        # the manifest only lists tiles with an image
+        return True
+    return unbundle.has_map_tile(lod, y, x)
+
+def tile_validator(lod, y, x):
+    """returns the etag and modification time of whatever will be
+    served for the tile, or None if it won't come from a bundle. a tile
+    made up from an ancestor gets the validator of the ancestor, found
+    the same way overzoom_tile finds it, so it changes with it
+    """
+    validator = None
+    if tile_exists(lod, y, x):
+        validator = read_tile_validator(lod, y, x)
+        if validator and (not OVERZOOM or tile_has_image(lod, y, x)):
+            return validator
+
+    if OVERZOOM:
+        lod, y, x = int(lod), int(y), int(x)
+        for level, parent_y, parent_x, scale in ancestors(lod, y, x):
+            if not tile_exists(level, parent_y, parent_x):
+                continue
+            parent = read_tile_validator(level, parent_y, parent_x)
+            if parent and tile_has_image(level, parent_y, parent_x):
+                return '{}-{}'.format(parent[0], scale), parent[1]
+
+    # an empty slot with nothing to make it up from, a placeholder
+    return validator
+
+def request_tile_validator(request, lod, y, x):
+    """returns tile_validator, worked out once per request for both the
+    etag and last modified functions
+    """
+    key = (lod, y, x)
+    cached = getattr(request, 'tile_validator', None)
+    if cached is None or cached[0] != key:
+        cached = key, tile_validator(lod, y, x)
+        request.tile_validator = cached
+    return cached[1]
+
+def tile_etag(lod, y, x, image_format, validator):
+    """returns the etag of the tile in image_format, given its
+    tile_validator
+    """
+    if image_format is None:
+        return None
+    suffix = '' if image_format == transcode.DEFAULT_FORMAT else '-' + image_format
+
+    if validator:
+        return validator[0] + suffix
+
+    if not tile_exists(lod, y, x):
+        return BLANK_TILE_ETAG if MISSING_TILE == 'blank' else None
+
+    # no bundle, this will be a placeholder
     content = 'Tile: {} / {} / {}'.format(lod, y, x)
-    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return hashlib.sha1(content.encode('utf-8')).hexdigest() + suffix
+
+def generate_tile_etag(request, lod, y, x):
+    return tile_etag(lod, y, x, negotiate_format(request),
+                     request_tile_validator(request, lod, y, x))
+
+def generate_tile_last_modified(request, lod, y, x):
+    validator = request_tile_validator(request, lod, y, x)
+    if validator:
+        return datetime.utcfromtimestamp(validator[1])
+
+def tile_max_age(lod):
+    for level, max_age in TILE_MAX_AGE:
+        if lod <= level:
+            break
+    return max_age
+
+def add_tile_cache_headers(response, lod):
+    max_age = tile_max_age(lod)
+    patch_cache_control(response, public=True, max_age=max_age)
+    response['Expires'] = http_date(time.time() + max_age)
+    return response
 
 #@etag(generate_tile_etag)
 #def tile(request, lod, y, x):
@@ -127,20 +867,117 @@ def generate_tile_etag(request, lod, y, x):
 #        else:
 #    return HttpResponseBadRequest('Invalid Tile Request')
 
-@etag(generate_tile_etag)
+@condition(etag_func=generate_tile_etag,
+           last_modified_func=generate_tile_last_modified)
 def tile(request, lod, y, x):
-    myform = TileImageForm({'lod': lod,'y': y, 'x': x})
-    form = TileForm({'lod': lod,'y': y, 'x': x})
+    form = TileImageForm({'lod': lod,'y': y, 'x': x})
+    image_format = negotiate_format(request)
+
+    if form.is_valid() and image_format:
+        lod = form.cleaned_data['lod']
+        y = form.cleaned_data['y']
+        x = form.cleaned_data['x']
+
+        if not tile_exists(lod, y, x) and not (OVERZOOM and
+                                               overzoom_source(lod, y, x)):
+            if MISSING_TILE == 'blank':
+                response = HttpResponse(BLANK_TILE, content_type='image/png')
+            else:
+                response = HttpResponseNotFound('Tile Not Found')
+            return add_tile_cache_headers(response, lod)
+
+        if (TILE_SENDFILE and tile_reader is None
+                and image_format == transcode.DEFAULT_FORMAT
+                and lod >= SENDFILE_MIN_LEVEL and tile_exists(lod, y, x)):
+            tile_range = form.generate_range()
+            if tile_range:
+                path, offset, length = tile_range
+                response = FileResponse(BundleRange(path, offset, length),
+                                        content_type='image/png')
+                response['Content-Length'] = length
+                return add_tile_cache_headers(response, lod)
+
+        image = form.generate()
+        image = transcoder.get((lod, y, x), image, image_format)
 
-    if myform.is_valid():
-        image = myform.generate()
-        if not image:
-            if form.is_valid():
-                image = form.generate()
-        return HttpResponse(image, content_type='image/png')
+        response = HttpResponse(image,
+                                content_type=transcode.content_type(image_format))
+        patch_vary_headers(response, ('Accept',))
+        return add_tile_cache_headers(response, lod)
     else:
         return HttpResponseBadRequest('Invalid Tile Request')
 
+def tiles(request, lod):
+    """returns every tile listed in ?tiles=y,x;y,x;... for one level
+    as a stream of records, each a big endian (y, x, length) header of
+    three unsigned ints followed by length bytes of png. tiles that
+    don't exist have a length of 0 when MISSING_TILE is 404
+    """
+    form = TileBatchForm({'lod': lod, 'tiles': request.GET.get('tiles', '')})
+
+    if form.is_valid():
+        records = form.generate()
+        stream = (struct.pack('>III', y, x, len(image)) + image
+                  for y, x, image in records)
+        return StreamingHttpResponse(stream,
+                                     content_type='application/octet-stream')
+    else:
+        return HttpResponseBadRequest('Invalid Tiles Request')
+
+def export_map(request):
+    """returns an image of ?bbox=xmin,ymin,xmax,ymax (in the spatial
+    reference of the service) with ?size=width,height and ?format=png,
+    png8 or jpg, pasted together from the cached tiles
+    """
+    form = ExportForm(request.GET)
+
+    if form.is_valid():
+        try:
+            image, content_type = form.generate()
+        except ValueError:
+            return HttpResponseBadRequest('Invalid Export Request')
+        return HttpResponse(image, content_type=content_type)
+    else:
+        return HttpResponseBadRequest('Invalid Export Request')
+
+def find_address_candidates(request):
+    """returns the candidates for ?SingleLine, at most ?maxLocations of
+    them, with the ?outFields of each, in the spatial reference ?outSR
+    """
+    form = FindCandidatesForm(request.GET)
+
+    if form.is_valid():
+        return StreamingHttpResponse(form.generate(),
+                                     content_type='application/json')
+    else:
+        return HttpResponseBadRequest('Invalid Find Address Candidates Request')
+
+@csrf_exempt
+def geocode_addresses(request):
+    """returns the best match for each of the ?addresses records, with
+    the ?outFields of each, in the spatial reference ?outSR. takes a get
+    or a form post
+    """
+    form = GeocodeAddressesForm(request.POST if request.method == 'POST'
+                                else request.GET)
+
+    if form.is_valid():
+        return StreamingHttpResponse(form.generate(),
+                                     content_type='application/json')
+    else:
+        return HttpResponseBadRequest('Invalid Geocode Addresses Request')
+
+def reverse_geocode(request):
+    """returns the addresses nearest to ?location=x,y, within ?distance
+    feet, at most ?maxLocations of them, in the spatial reference ?outSR
+    """
+    form = ReverseGeocodeForm(request.GET)
+
+    if form.is_valid():
+        return HttpResponse(form.generate(), content_type='application/json')
+    else:
+        return HttpResponseBadRequest('Invalid Reverse Geocode Request')
+
 def index(request):
   example = reverse('tile', kwargs={'lod':1, 'y':2375, 'x':1873})
   context = {
@@ -160,15 +997,120 @@ def service_description(request):
 def viewer(request):
     return render(request, 'viewer.html')
 
+def metrics_view(request):
+    """returns the stage timings and cache counters in the prometheus
+    text format
+    """
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4')
+
+class ProfileMiddleware(object):
+    """with PROFILE_REQUESTS on, answers a request that has ?profile=1
+    with the collapsed stacks sampled while its view ran, instead of
+    its response
+    """
+    def process_view(self, request, view, view_args, view_kwargs):
+        if request.GET.get('profile') != '1':
+            return None
+
+        with metrics.Sampler() as sampler:
+            response = view(request, *view_args, **view_kwargs)
+            # streamed content is produced after the view returns
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+
+        return HttpResponse(sampler.collapsed(), content_type='text/plain')
+
+def warm_transcodes():
+    """transcodes the tiles of TRANSCODE_WARM_LEVELS, in the background"""
+    if not TRANSCODE_WARM_LEVELS or tile_manifest is None:
+        return
+
+    levels = transcode.parse_levels(TRANSCODE_WARM_LEVELS)
+    formats = [image_format for image_format in TRANSCODE_WARM_FORMATS.split(',')
+               if image_format in TILE_FORMATS]
+
+    def warm():
+        for image_format in formats:
+            transcoder.warm(transcode.manifest_tiles(tile_manifest, levels),
+                            image_format, read_tile)
+
+    thread = threading.Thread(target=warm, name='transcode-warm')
+    thread.daemon = True
+    thread.start()
+
+def bundle_keys(level, name):
+    """returns a predicate for the cache keys (lod, y, x, ...) of the
+    tiles served from the bundle, including the finer tiles overzoomed
+    from it
+    """
+    first_row, first_col = unbundle.bundle_origin(name)
+    last_row = first_row + unbundle.TILES_PER_SIDE
+    last_col = first_col + unbundle.TILES_PER_SIDE
+
+    def matches(key):
+        lod, y, x = key[:3]
+        if lod == level:
+            scale = 1
+        elif lod > level and OVERZOOM and lod in RESOLUTIONS:
+            scale = int(round(RESOLUTIONS[level] / RESOLUTIONS[lod]))
+        else:
+            return False
+        return (first_row <= y // scale < last_row and
+                first_col <= x // scale < last_col)
+
+    return matches
+
+def on_bundle_change(level, name, path):
+    """forgets everything cached from a bundle that was rewritten,
+    added or removed, leaving the other bundles alone
+    """
+    unbundle.invalidate_bundle(path)
+
+    try:
+        if tile_manifest is not None:
+            if os.path.exists(path + ".bundlx"):
+                tile_manifest.set_bundle(level, name, manifest.scan_bundle(path))
+            else:
+                tile_manifest.set_bundle(level, name, None)
+    finally:
+        # after the manifest, so placeholders aren't cached again from it
+        matches = bundle_keys(level, name)
+        tile_cache.discard_matching(matches)
+        transcoder.cache.discard_matching(matches)
+
+def watch_tiles():
+    """polls the bundles every WATCH_TILES seconds, in the background"""
+    if not WATCH_TILES or tile_reader is not None:
+        return None
+
+    tile_watcher = watcher.CacheWatcher("files/", WATCH_TILES, on_bundle_change)
+    tile_watcher.start()
+    return tile_watcher
+
 urlpatterns = (
   url(r'^GIS/REST/MapTiled/GreyScale/MapServer/tile/(?P<lod>[0-9]+)/(?P<y>[0-9]+)/(?P<x>[0-9]+)', tile, name='tile'),
+  url(r'^GIS/REST/MapTiled/GreyScale/MapServer/tiles/(?P<lod>[0-9]+)', tiles, name='tiles'),
+  url(r'^GIS/REST/MapTiled/GreyScale/MapServer/export', export_map, name='export'),
   url(r'^GIS/REST/MapTiled/GreyScale/MapServer', service_description, name='service_description'),
   url(r'^GIS/REST/MapTiled/GreyScale/Viewer', viewer, name='viewer'),
+  url(r'^GIS/REST/Locators/Address/GeocodeServer/findAddressCandidates', find_address_candidates, name='find_address_candidates'),
+  url(r'^GIS/REST/Locators/Address/GeocodeServer/geocodeAddresses', geocode_addresses, name='geocode_addresses'),
+  url(r'^GIS/REST/Locators/Address/GeocodeServer/reverseGeocode', reverse_geocode, name='reverse_geocode'),
+  url(r'^metrics$', metrics_view, name='metrics'),
   url(r'^$', index, name='homepage'),
 )
 
 application = get_wsgi_application()
 
+warm_transcodes()
+
+if GEOCODE_PRELOAD:
+    locator.preload()
+
+tile_watcher = watch_tiles()
+
 if __name__ == "__main__":
   from django.core.management import execute_from_command_line
 
@@ -0,0 +1,77 @@
+import os, random, shutil, tempfile, unittest
+
+import addressindex, addressstore
+
+STREETS = ('BARTON SPRINGS', 'CONGRESS', 'LAMAR', 'OAK', 'OAK HILL',
+           'RIVERSIDE', 'SOUTH FIRST', 'ZILKER')
+
+def records(count, seed=0):
+    """yields (fields, x, y) for count address points on STREETS"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        street = rng.choice(STREETS)
+        number = rng.randrange(100, 5000, 2)
+        fields = {'address': str(number),
+                  'street_nam': street,
+                  'street_typ': rng.choice(('RD', 'ST', 'AVE')),
+                  'place_id': str(rng.randrange(1000000)),
+                  'full_stree': '{} {}'.format(number, street)}
+        yield fields, 3100000 + rng.random() * 20000, 10060000 + rng.random() * 20000
+
+class AddressStoreRoundTripTest(unittest.TestCase):
+    """an index written to a store and mapped back answers every lookup
+    the same as the index it was written from
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'address_point.shp')
+        self.path = os.path.join(self.directory, 'address_point.store')
+        with open(self.source, 'w') as file:
+            file.write('shapefile')
+
+        self.index = addressindex.AddressIndex.build(records(2000))
+        addressstore.write(self.index, self.path, self.source)
+        self.store = addressstore.open_store(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        self.assertEqual(len(self.store), len(self.index))
+        for row in range(0, len(self.index), 37):
+            self.assertEqual(self.store.record(row), self.index.record(row))
+
+    def test_find(self):
+        for query in ((2200, 'BARTON SPRINGS'), (1000, 'OAK'), (None, 'LAMAR'),
+                      (300, 'BARTEN SPRINGS'), (300, 'RIVRSIDE'),
+                      (300, 'NOWHERE'), (300, None)):
+            self.assertEqual(self.store.find(*query, over_under=20),
+                             self.index.find(*query, over_under=20))
+
+    def test_streets(self):
+        for street in range(len(self.index.streets)):
+            name = self.index.street_name(street)
+            self.assertEqual(self.store.street_id(name), street)
+            self.assertEqual(self.store.similar_streets(name[:-1]),
+                             self.index.similar_streets(name[:-1]))
+        self.assertIsNone(self.store.street_id('NOWHERE'))
+
+    def test_nearest(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            x = 3100000 + rng.random() * 20000
+            y = 10060000 + rng.random() * 20000
+            self.assertEqual(self.store.nearest(x, y, 3, 600),
+                             self.index.nearest(x, y, 3, 600))
+
+    def test_is_current(self):
+        self.assertTrue(addressstore.is_current(self.path, self.source))
+
+        stat = os.stat(self.source)
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 1))
+        self.assertFalse(addressstore.is_current(self.path, self.source))
+        self.assertFalse(addressstore.is_current(self.path + '.missing',
+                                                 self.source))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os, shutil, tempfile, unittest
+
+import unbundle
+
+class BundleRoundTripTest(unittest.TestCase):
+    """tiles written with BundleWriter read back the same through every
+    reader, so a change to either side of the layout is caught
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        # bundle_path is relative to files/ in the working directory
+        os.chdir(self.directory)
+        os.makedirs(os.path.join("files", "L03"))
+
+        self.tiles = {}
+        for row in range(128, 256, 7):
+            for col in range(384, 512, 11):
+                self.tiles[(row, col)] = "tile {} {} ".format(
+                    row, col).encode('ascii') * ((row * col) % 50 + 1)
+        self.path = unbundle.bundle_path(3, 128, 384)
+        unbundle.write_bundle(self.path, self.tiles)
+
+    def tearDown(self):
+        unbundle.invalidate_bundle(self.path)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_get_map_tile(self):
+        for (row, col), image in self.tiles.items():
+            self.assertEqual(bytes(unbundle.get_map_tile(3, row, col)), image)
+
+    def test_get_map_tiles(self):
+        images = unbundle.get_map_tiles(3, list(self.tiles))
+        self.assertEqual(dict((key, bytes(image)) for key, image in images.items()),
+                         self.tiles)
+
+    def test_get_map_tile_range(self):
+        row, col = sorted(self.tiles)[3]
+        path, offset, length = unbundle.get_map_tile_range(3, row, col)
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            self.assertEqual(file.read(length), self.tiles[(row, col)])
+
+    def test_empty_slot(self):
+        self.assertNotIn((129, 384), self.tiles)
+        self.assertEqual(len(unbundle.get_map_tile(3, 129, 384)), 0)
+        self.assertIsNone(unbundle.get_map_tile_range(3, 129, 384))
+        self.assertFalse(unbundle.has_map_tile(3, 129, 384))
+        self.assertTrue(unbundle.has_map_tile(3, 128, 384))
+
+    def test_validator_follows_position(self):
+        first = unbundle.get_tile_validator(3, 128, 384)
+        second = unbundle.get_tile_validator(3, 135, 384)
+        self.assertIsNotNone(first)
+        self.assertNotEqual(first[0], second[0])
+        self.assertIsNone(unbundle.get_tile_validator(3, 0, 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import threading
+from collections import OrderedDict
+
+PROTECTED_RATIO = 0.8
+
+class TileCache(object):
+    """in process cache of encoded tiles, bounded by the total size of
+    the stored bytes rather than the number of entries.
+
+    this is a segmented lru: new tiles go into a probation segment and
+    are only promoted to the protected segment when they are hit again,
+    so a single sweep across the map (every tile seen once) can only
+    churn probation and never flushes the hot, repeatedly hit tiles
+    """
+    def __init__(self, max_bytes, protected_ratio=PROTECTED_RATIO):
+        self.max_bytes = max_bytes
+        self.protected_max = int(max_bytes * protected_ratio)
+
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    @property
+    def size(self):
+        return self.probation_bytes + self.protected_bytes
+
+    def get(self, key):
+        """returns the cached bytes for key, or None"""
+        with self.lock:
+            value = self.protected.get(key)
+            if value is not None:
+                self.protected.move_to_end(key)
+                self.hits += 1
+                return value
+
+            value = self.probation.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+
+            # second hit, promote
+            self.probation_bytes -= len(value)
+            self.protected[key] = value
+            self.protected_bytes += len(value)
+            self._demote()
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """stores value (bytes) under key"""
+        value = bytes(value)
+        if len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            self._discard(key)
+            self.probation[key] = value
+            self.probation_bytes += len(value)
+            self._evict()
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def discard_matching(self, predicate):
+        """drops every entry whose key satisfies predicate,
+        returns the number of entries dropped
+        """
+        with self.lock:
+            keys = [key for key in self.probation if predicate(key)]
+            keys += [key for key in self.protected if predicate(key)]
+            for key in keys:
+                self._discard(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.probation.clear()
+            self.protected.clear()
+            self.probation_bytes = 0
+            self.protected_bytes = 0
+
+    def stats(self):
+        """returns a dictionary of counters and sizes"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.probation) + len(self.protected),
+                'bytes': self.probation_bytes + self.protected_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _discard(self, key):
+        value = self.probation.pop(key, None)
+        if value is not None:
+            self.probation_bytes -= len(value)
+            return
+        value = self.protected.pop(key, None)
+        if value is not None:
+            self.protected_bytes -= len(value)
+
+    def _demote(self):
+        """moves the least recently used protected entries back to
+        probation until protected fits its share of the budget
+        """
+        while self.protected_bytes > self.protected_max:
+            key, value = self.protected.popitem(last=False)
+            self.protected_bytes -= len(value)
+            self.probation[key] = value
+            self.probation_bytes += len(value)
+        self._evict()
+
+    def _evict(self):
+        while self.probation_bytes + self.protected_bytes > self.max_bytes:
+            if self.probation:
+                key, value = self.probation.popitem(last=False)
+                self.probation_bytes -= len(value)
+            else:
+                key, value = self.protected.popitem(last=False)
+                self.protected_bytes -= len(value)
+            self.evictions += 1
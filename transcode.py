@@ -0,0 +1,180 @@
+import os, sys, time, argparse
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+import tilecache, manifest, unbundle, coalesce
+
+# format name -> (pil format, content type), png is served as stored
+FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'png8': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+DEFAULT_FORMAT = 'png'
+
+WEBP_QUALITY = 80
+
+def supported_formats():
+    formats = set(FORMATS)
+    if not features.check('webp'):
+        formats.discard('webp')
+    return formats
+
+def content_type(image_format):
+    return FORMATS[image_format][1]
+
+def transcode(image, image_format):
+    """returns the png image re-encoded as image_format"""
+    source = Image.open(BytesIO(image))
+    content = BytesIO()
+
+    if image_format == 'png8':
+        if source.mode != 'P':
+            source = source.convert('RGBA').quantize(256, method=Image.FASTOCTREE)
+        source.save(content, 'PNG', optimize=True)
+    elif image_format == 'webp':
+        if source.mode not in ('RGB', 'RGBA'):
+            source = source.convert('RGBA')
+        source.save(content, 'WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        raise Exception("Unsupported format: {}".format(image_format))
+
+    return content.getvalue()
+
+class Transcoder(object):
+    """transcodes tiles on a pool of worker threads, keeping the results
+    in their own size bounded cache keyed by (level, row, col, format)
+    """
+    def __init__(self, max_bytes, workers):
+        self.cache = tilecache.TileCache(max_bytes)
+        self.executor = ThreadPoolExecutor(workers)
+        self.flight = coalesce.SingleFlight()
+
+    def get(self, key, image, image_format):
+        """returns the tile for key (level, row, col) in image_format,
+        given its png image
+        """
+        if image_format == DEFAULT_FORMAT:
+            return image
+
+        cache_key = tuple(key) + (image_format,)
+        content = self.cache.get(cache_key)
+        if content is None:
+            content = self.flight.do(cache_key, self._transcode, cache_key,
+                                     image, image_format)
+        return content
+
+    def _transcode(self, cache_key, image, image_format):
+        content = self.executor.submit(transcode, image, image_format).result()
+        self.cache.put(cache_key, content)
+        return content
+
+    def warm(self, tiles, image_format, read, window=64):
+        """transcodes every (level, row, col) in tiles into image_format
+        ahead of time, reading the png images with read and keeping at
+        most window of them in flight. returns the number of tiles
+        tried and the total size of those transcoded, before and after
+        """
+        count = 0
+        before = 0
+        after = 0
+        pending = deque()
+
+        def finish():
+            key, image, future = pending.popleft()
+            try:
+                content = future.result()
+            except Exception as e:
+                # not worth stopping for, it'll fail again when requested
+                print("{}: {}".format(key, e))
+                return 0, 0
+            self.cache.put(key + (image_format,), content)
+            return len(image), len(content)
+
+        for key in tiles:
+            image = read(*key)
+            if not image:
+                continue
+            image = bytes(image)
+
+            future = self.executor.submit(transcode, image, image_format)
+            pending.append((tuple(key), image, future))
+            while len(pending) >= window or (pending and pending[0][2].done()):
+                size, transcoded = finish()
+                count += 1
+                before += size
+                after += transcoded
+
+        while pending:
+            size, transcoded = finish()
+            count += 1
+            before += size
+            after += transcoded
+
+        return count, before, after
+
+def manifest_tiles(tile_manifest, levels):
+    """yields (level, row, col) for every tile the manifest has on the
+    given levels
+    """
+    for level in levels:
+        bundles = tile_manifest.levels.get(level, {})
+        for name, bitmap in sorted(bundles.items()):
+            first_row, first_col = unbundle.bundle_origin(name)
+            for bit in range(unbundle.TILES_PER_BUNDLE):
+                if bitmap[bit >> 3] & (1 << (bit & 7)):
+                    yield (level,
+                           first_row + bit % unbundle.TILES_PER_SIDE,
+                           first_col + bit // unbundle.TILES_PER_SIDE)
+
+def parse_levels(value):
+    """parses "0-5" or "0,1,2" into a list of levels"""
+    levels = []
+    for part in value.split(','):
+        if '-' in part:
+            low, high = part.split('-')
+            levels.extend(range(int(low), int(high) + 1))
+        elif part:
+            levels.append(int(part))
+    return levels
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="transcode the tiles of some levels and report the "
+                    "sizes, the server does the same at startup when "
+                    "TRANSCODE_WARM_LEVELS is set")
+    parser.add_argument('root', nargs='?', default="files/",
+                        help="the cache directory, holding the Lxx folders")
+    parser.add_argument('--levels', type=parse_levels, default=[0, 1, 2, 3, 4, 5])
+    parser.add_argument('--formats', default='webp,png8')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    options = parser.parse_args(args[1:])
+
+    tile_manifest = manifest.load(os.path.join(options.root, "manifest.json"))
+    if tile_manifest is None:
+        tile_manifest = manifest.build(options.root)
+
+    formats = [image_format for image_format in options.formats.split(',')
+               if image_format in supported_formats()]
+
+    def read(level, row, col):
+        path = os.path.join(options.root, "L%02d" % level,
+                            unbundle.bundle_name(row, col))
+        return unbundle.tile_image(path, row, col)
+
+    # nothing is kept, only the sizes are of interest here
+    transcoder = Transcoder(0, options.workers)
+    for image_format in formats:
+        start = time.time()
+        count, before, after = transcoder.warm(
+            manifest_tiles(tile_manifest, options.levels), image_format, read)
+
+        print("{}: transcoded {} tiles in {:.1f}s, {} bytes to {} bytes"
+              .format(image_format, count, time.time() - start, before, after))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,5 +1,8 @@
-import os, sys, mmap, re, struct
-from collections import namedtuple
+import os, sys, mmap, re, struct, threading
+from array import array
+from collections import OrderedDict
+
+import metrics
 
 def bundle_name(row, col):
     """returns the name of the bundle that will hold the image,
@@ -18,6 +21,15 @@ def bundle_name(row, col):
     name = "R{}C{}".format(row, col)
     return name
 
+def bundle_origin(name):
+    """returns the row and column of the first image in the bundle
+    with the given name, the reverse of bundle_name
+    """
+    match = re.match(r"^R([0-9a-fA-F]{4})C([0-9a-fA-F]{4})$", name)
+    if not match:
+        raise Exception("Invalid bundle name: {}".format(name))
+    return int(match.group(1), 16), int(match.group(2), 16)
+
 def index_position(row, col):
     """given a row and column, returns the position in the index
     file where you can find the position of the actual image
@@ -53,92 +65,243 @@ def sum_bytes(chunk):
 
     return value
 
-TileInfo = namedtuple("TileInfo",["path","row","column"])
-tile_pos_dict = {}
-
-def tile_position(path, row, column):
-    """reads from the index file and returns the position of the
-    image in the bundle file, given the path of the index file
-    and the row and column fo the image
-    """
-    tile_info = TileInfo(path=path, row=row, column=column)
-    if tile_info in tile_pos_dict.keys():
-        #print("returning positiong from dictionary")
-        return tile_pos_dict[tile_info]
-
-    position = index_position(row, column)
-    path += ".bundlx"
-
-    file = open(path, 'r+b')
+TILES_PER_SIDE = 128
+TILES_PER_BUNDLE = TILES_PER_SIDE * TILES_PER_SIDE
+INDEX_HEADER_SIZE = 16
+INDEX_RECORD_SIZE = 5
+INDEX_REGISTRY_SIZE = 512
+BUNDLE_HEADER_SIZE = 60
 
-    length = position % mmap.PAGESIZE + 5
-    start = int(position/mmap.PAGESIZE) * mmap.PAGESIZE
-    file_size = os.fstat(file.fileno()).st_size
-    if length > file_size - start:
-        length = file_size - start
+# the bundle header is followed by a zero size record per slot, which
+# the index entries of empty slots point at
+EMPTY_RECORDS_END = BUNDLE_HEADER_SIZE + 4 * TILES_PER_BUNDLE
 
-    mm = mmap.mmap(file.fileno(), length, offset=start)
+# each 5 byte record is a little endian uint32 followed by the high byte
+_index_struct = struct.Struct('<' + 'IB' * TILES_PER_BUNDLE)
 
-    m = position - start
-    n = m + 5
+class BundleIndex(object):
+    """the decoded contents of a .bundlx file, the position of every
+    image in the matching bundle file, held in a flat array ordered
+    the same way as the index file (column major)
+    """
+    def __init__(self, path, offsets, mtime=0, bundle_size=0):
+        self.path = path
+        self.offsets = offsets
+        self.mtime = mtime
+        self.bundle_size = bundle_size
+
+    @classmethod
+    def load(cls, path):
+        """reads the whole index file for the bundle at path (without
+        extension) and decodes all of the offsets in one pass
+        """
+        with open(path + ".bundlx", 'rb') as file:
+            data = file.read()
+
+        # recorded so validators can be answered from the index alone
+        stat = os.stat(path + ".bundle")
+
+        end = INDEX_HEADER_SIZE + TILES_PER_BUNDLE * INDEX_RECORD_SIZE
+        if len(data) < end:
+            raise Exception("Invalid index file: {}.bundlx".format(path))
+
+        values = _index_struct.unpack_from(data, INDEX_HEADER_SIZE)
+        offsets = array('Q', values[0::2])
+
+        # bundles over 4gb are rare, only pay for the high byte if needed
+        high = values[1::2]
+        if any(high):
+            for i, value in enumerate(high):
+                if value:
+                    offsets[i] += value << 32
+
+        return cls(path, offsets, stat.st_mtime, stat.st_size)
+
+    def position(self, row, column):
+        """returns the position of the image in the bundle file"""
+        row = row % TILES_PER_SIDE
+        column = column % TILES_PER_SIDE
+        return self.offsets[column * TILES_PER_SIDE + row]
+
+    def has_image(self, row, column):
+        """returns whether the slot holds an image, an empty slot points
+        at the zero size records after the bundle header
+        """
+        return self.position(row, column) >= EMPTY_RECORDS_END
+
+    def validator(self, row, column):
+        """returns a string that changes whenever the image at row and
+        column may have changed, built from the bundle's modification
+        time and size and the position of the image. nothing in it is
+        local to the process, so every worker gives the same one
+        """
+        return "{:x}-{:x}-{:x}".format(int(self.mtime * 1000),
+                                       self.bundle_size,
+                                       self.position(row, column))
+
+_index_registry = OrderedDict()
+_index_lock = threading.Lock()
+
+# bumped every time a bundle is invalidated, so an index loaded while
+# its bundle was being replaced isn't kept
+_generations = {}
+
+def get_bundle_index(path):
+    """returns the resident index for the bundle at path (without
+    extension), loading it on first use. the registry holds at most
+    INDEX_REGISTRY_SIZE indexes, least recently used are dropped first
+    """
+    with _index_lock:
+        index = _index_registry.get(path)
+        if index is not None:
+            _index_registry.move_to_end(path)
+            return index
+        generation = _generations.get(path, 0)
+
+    index = BundleIndex.load(path)
+
+    with _index_lock:
+        # don't keep it if the bundle changed while it was loading
+        if _generations.get(path, 0) == generation:
+            _index_registry[path] = index
+            _index_registry.move_to_end(path)
+            while len(_index_registry) > INDEX_REGISTRY_SIZE:
+                _index_registry.popitem(last=False)
+
+    return index
+
+def invalidate_bundle(path):
+    """forgets everything held for the bundle at path (without
+    extension), its resident index and its mapped bundle file, so the
+    next read loads the new ones and validators follow the new bundle's
+    modification time and size. call it after the bundle has been
+    replaced
+    """
+    with _index_lock:
+        _index_registry.pop(path, None)
+        _generations[path] = _generations.get(path, 0) + 1
+    bundle_pool.close(path + ".bundle")
 
-    tile_pos = sum_bytes(mm[m:n])
+INDEX_SECONDS = metrics.histogram(
+    'tile_stage_seconds', "time spent in each stage of serving a tile",
+    stage='index')
 
-    mm.close()
-    file.close()
+READ_SECONDS = metrics.histogram(
+    'tile_stage_seconds', "time spent in each stage of serving a tile",
+    stage='read')
 
-    tile_pos_dict[tile_info] = tile_pos
-    return tile_pos
+def tile_position(path, row, column):
+    """reads from the index file and returns the position of the
+    image in the bundle file, given the path of the index file
+    and the row and column fo the image
+    """
+    return get_bundle_index(path).position(row, column)
+
+BUNDLE_POOL_SIZE = 64
+
+class BundleFile(object):
+    """a read only memory map of a whole bundle file"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            # the map keeps its own descriptor, the file can be closed
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+
+    def extent(self, position):
+        """returns the offset and size of the image stored at position"""
+        size = struct.unpack_from('<i', self.mm, position)[0]
+        return position + 4, size
+
+    def read(self, position):
+        """returns a memoryview of the image stored at position,
+        sliced to exactly the embedded size
+        """
+        start, size = self.extent(position)
+        return self.view[start:start + size]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # slices are still out there, the map is unmapped
+            # when the last of them is garbage collected
+            pass
+
+class BundlePool(object):
+    """keeps up to size bundle files mapped, closing the least
+    recently used when another one is needed
+    """
+    def __init__(self, size=BUNDLE_POOL_SIZE):
+        self.size = size
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, path, position):
+        """returns a memoryview of the image at position in the
+        bundle file at path
+        """
+        with self.lock:
+            # read under the lock so the map can't be closed under us
+            return self._get(path).read(position)
+
+    def extent(self, path, position):
+        """returns the offset and size of the image at position in
+        the bundle file at path
+        """
+        with self.lock:
+            return self._get(path).extent(position)
+
+    def _get(self, path):
+        bundle = self.files.get(path)
+        if bundle is None:
+            bundle = BundleFile(path)
+            self.files[path] = bundle
+            while len(self.files) > self.size:
+                self.files.popitem(last=False)[1].close()
+        else:
+            self.files.move_to_end(path)
+        return bundle
+
+    def close(self, path=None):
+        """closes the bundle file at path, or all of them"""
+        with self.lock:
+            if path is None:
+                paths = list(self.files.keys())
+            else:
+                paths = [path] if path in self.files else []
+            for key in paths:
+                self.files.pop(key).close()
+
+bundle_pool = BundlePool()
 
 def tile_image(path, row, column):
     """returns the binary array of the image from the bundle file,
     given the path of the bundle file, and the row and column
     of the image
     """
-    position = tile_position(path, row, column)
-
-    path += ".bundle"
-    file = open(path, 'r+b')
-
-    # this is a hack that could break things,
-    # but hopefully saves a lot of memory
-    length = 8 * mmap.PAGESIZE
-    start = int(position/mmap.PAGESIZE) * mmap.PAGESIZE
-    file_size = os.fstat(file.fileno()).st_size
-    if length > file_size - start:
-        length = file_size - start
-
-    mm = mmap.mmap(file.fileno(), length, offset=start)
-
-    # read the size of the embedded image
-    m = position-start
-    n = m + 4
-
-    size = struct.unpack('i',mm[m:n])[0]
-
-    # read the size the image itself
-    m = n
-    n = m + size
-
-    image = mm[m:n]
-
-    print("path: {}, pos: {}, size: {}, row: {}, col: {}"\
-                    .format(path, position, size, row, column))
-
-    mm.close()
-    file.close()
-
-    return image
+    with INDEX_SECONDS.time():
+        position = tile_position(path, row, column)
+    with READ_SECONDS.time():
+        return bundle_pool.read(path + ".bundle", position)
+
+def bundle_path(level, row, column):
+    """returns the path, without extension, of the bundle that will
+    hold the image, given the level, row and column
+    """
+    level = "L%02d" % int(level)
+    return os.path.join("files/", level, bundle_name(row, column))
 
 def get_map_tile(level, row, column):
     """returns the binary array of the image, if it exists, given the
-    level, row and column
+    level, row and column. the array is a memoryview into the mapped
+    bundle file, copy it if it needs to outlive the bundle pool entry
     """
-    level = "L%02d" % int(level)
     row   = int(row)
     col   = int(column)
 
-    path  = os.path.join("files/", level, bundle_name(row, col))
+    path  = bundle_path(level, row, col)
     image = None
 
     try:
@@ -150,6 +313,165 @@ def get_map_tile(level, row, column):
 
     return image
 
+def get_tile_validator(level, row, column):
+    """returns the validator string and the modification time of the
+    bundle holding the image, given the level, row and column, without
+    reading the bundle file. returns None if the bundle doesn't exist
+    """
+    row  = int(row)
+    col  = int(column)
+    path = bundle_path(level, row, col)
+
+    try:
+        index = get_bundle_index(path)
+    except (IOError, OSError):
+        return None
+
+    return index.validator(row, col), index.mtime
+
+def has_map_tile(level, row, column):
+    """returns whether the bundle holds an image for the level, row and
+    column, from the index alone
+    """
+    row  = int(row)
+    col  = int(column)
+    path = bundle_path(level, row, col)
+
+    try:
+        return get_bundle_index(path).has_image(row, col)
+    except (IOError, OSError):
+        return False
+
+def get_map_tile_range(level, row, column):
+    """returns the path of the bundle file, and the offset and length
+    of the image in it, given the level, row and column. returns None
+    if the image doesn't exist
+    """
+    row  = int(row)
+    col  = int(column)
+    path = bundle_path(level, row, col)
+
+    try:
+        position = tile_position(path, row, col)
+        path += ".bundle"
+        offset, size = bundle_pool.extent(path, position)
+    except (IOError, OSError) as e:
+        print("{}: {}".format(type(e), e.strerror))
+        return None
+    except Exception as e:
+        print("{}: {}".format(type(e), e.args))
+        return None
+
+    if size <= 0:
+        return None
+
+    return path, offset, size
+
+def get_map_tiles(level, tiles):
+    """returns a dictionary of (row, column) to the bytes of the image,
+    or None, for each of the (row, column) pairs in tiles. each bundle's
+    index is read once and its images are copied out of the map in
+    ascending file order, so the pages are faulted in sequentially
+    """
+    bundles = {}
+    for row, col in tiles:
+        row = int(row)
+        col = int(col)
+        path = bundle_path(level, row, col)
+        bundles.setdefault(path, []).append((row, col))
+
+    images = {}
+    for path, members in bundles.items():
+        try:
+            with INDEX_SECONDS.time():
+                index = get_bundle_index(path)
+                positions = sorted((index.position(row, col), row, col)
+                                   for row, col in members)
+            with READ_SECONDS.time():
+                for position, row, col in positions:
+                    images[(row, col)] = bytes(bundle_pool.read(path + ".bundle",
+                                                                position))
+        except (IOError, OSError) as e:
+            print("{}: {}".format(type(e), e.strerror))
+        except Exception as e:
+            print("{}: {}".format(type(e), e.args))
+
+        for key in members:
+            images.setdefault(key, None)
+
+    return images
+
+
+class BundleWriter(object):
+    """writes a bundle and its index, at path (without extension), in
+    the layout read above. images are streamed to the bundle file as
+    they are added, only their positions are held in memory. the files
+    are written under temporary names and moved into place on close,
+    so readers never see a half written bundle. the two renames are not
+    one atomic swap though: a running server keeps the index it read
+    and the bundle it mapped, and can pair an old index with a new
+    bundle, so replacing a bundle it serves needs a restart or the
+    watcher (WATCH_TILES), which drops both
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('Q', (BUNDLE_HEADER_SIZE + 4 * slot
+                                   for slot in range(TILES_PER_BUNDLE)))
+        self.max_size = 0
+        self.file = open(path + ".bundle.tmp", 'wb')
+
+        # the header is rewritten on close, followed by a zero size
+        # record per slot that empty slots in the index point at
+        self.file.write(bytes(EMPTY_RECORDS_END))
+        self.position = self.file.tell()
+
+    def add(self, row, column, image):
+        """appends the image for row and column (taken modulo 128)"""
+        row = row % TILES_PER_SIDE
+        column = column % TILES_PER_SIDE
+
+        self.offsets[column * TILES_PER_SIDE + row] = self.position
+        self.file.write(struct.pack('<i', len(image)))
+        self.file.write(image)
+        self.position += 4 + len(image)
+        self.max_size = max(self.max_size, len(image))
+
+    def close(self):
+        # the leading fields of the version 3 header, the readers here
+        # only ever look at the index
+        header = struct.pack('<4I2Q', 3, TILES_PER_BUNDLE, self.max_size,
+                             INDEX_RECORD_SIZE, 0, self.position)
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+
+        values = []
+        for offset in self.offsets:
+            values.append(offset & 0xffffffff)
+            values.append(offset >> 32)
+
+        with open(self.path + ".bundlx.tmp", 'wb') as file:
+            file.write(struct.pack('<4I', 3, INDEX_HEADER_SIZE,
+                                   TILES_PER_BUNDLE, INDEX_RECORD_SIZE))
+            file.write(_index_struct.pack(*values))
+            file.write(struct.pack('<4I', 0, INDEX_HEADER_SIZE,
+                                   INDEX_HEADER_SIZE, 0))
+
+        # readers load the index before they map the bundle, so with
+        # the bundle moved first a reader starting now pairs the old
+        # index with the new bundle until the index is moved too
+        os.rename(self.path + ".bundle.tmp", self.path + ".bundle")
+        os.rename(self.path + ".bundlx.tmp", self.path + ".bundlx")
+
+def write_bundle(path, tiles):
+    """writes a bundle and its index at path (without extension), given
+    a dictionary of (row, column) to image
+    """
+    writer = BundleWriter(path)
+    for (row, column), image in sorted(tiles.items()):
+        writer.add(row, column, image)
+    writer.close()
+
 def main(args):
     try:
         level = int(args[1])
@@ -0,0 +1,97 @@
+import os, sys, time, threading
+
+import manifest
+
+DEFAULT_INTERVAL = 5
+
+def scan(root):
+    """returns a dictionary of (level, bundle name) to the modification
+    times and sizes of the .bundle and .bundlx files under root
+    """
+    bundles = {}
+    for directory in os.listdir(root):
+        match = manifest.level_pattern.match(directory)
+        if not match:
+            continue
+
+        level = int(match.group(1))
+        path = os.path.join(root, directory)
+        if not os.path.isdir(path):
+            continue
+
+        for file_name in os.listdir(path):
+            name, extension = os.path.splitext(file_name)
+            if extension not in (".bundle", ".bundlx"):
+                continue
+            try:
+                stat = os.stat(os.path.join(path, file_name))
+            except OSError:
+                # removed since it was listed
+                continue
+            files = bundles.setdefault((level, name), {})
+            files[extension] = (stat.st_mtime, stat.st_size)
+
+    return bundles
+
+class CacheWatcher(object):
+    """polls the bundles under root every interval seconds and calls
+    on_change(level, name, path) for each bundle that was added, removed
+    or rewritten since the last poll. path is without extension, like
+    the paths unbundle uses
+    """
+    def __init__(self, root, interval=DEFAULT_INTERVAL, on_change=None):
+        self.root = root
+        self.interval = interval
+        self.on_change = on_change
+        self.bundles = scan(root) if os.path.isdir(root) else {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """compares the bundles with the last poll, returns the list of
+        (level, name) that changed
+        """
+        bundles = scan(self.root) if os.path.isdir(self.root) else {}
+        changed = [key for key in set(bundles) | set(self.bundles)
+                   if bundles.get(key) != self.bundles.get(key)]
+        self.bundles = bundles
+
+        for level, name in sorted(changed):
+            path = os.path.join(self.root, "L%02d" % level, name)
+            try:
+                self.on_change(level, name, path)
+            except Exception as e:
+                print("{}: {}".format(path, e))
+
+        return changed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print("{}: {}".format(type(e), e))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cache-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def main(args):
+    root = args[1] if len(args) > 1 else "files/"
+    interval = float(args[2]) if len(args) > 2 else DEFAULT_INTERVAL
+
+    def report(level, name, path):
+        print("{} L{:02d} {} changed".format(time.strftime('%H:%M:%S'),
+                                             level, name))
+
+    watcher = CacheWatcher(root, interval, report)
+    watcher.run()
+
+if __name__ == "__main__":
+    main(sys.argv)